@@ -1 +1,3 @@
-from .beatswap_ import beatswap_dict, beatswap
\ No newline at end of file
+from .beatswap_ import beatswap_dict, beatswap, beatswap_many
+from .batch import run_batch
+from .server import RenderServer, RenderClient
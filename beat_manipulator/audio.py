@@ -1,30 +1,146 @@
+import concurrent.futures
 import math
+import threading
+import typing
 from collections import abc
 
 import numpy as np
 
-from .beat_detection import detect_beat_this
-from .io_ import audioread
-from .utils import interpolate, tonumpy
+from . import profiling
+from .beat_detection import BEAT_CACHE, detect_beats_and_downbeats
+from .cache import DiskCache, make_key
+from .features import BeatFeatures
+from .io_ import AudioFileReader, audioread, audioread_mmap
+from .resample import RESAMPLE_CACHE, resample
+from .utils import audio_hash, interpolate, tonumpy
+
+_RESAMPLE_LOCK = threading.Lock()
+_RESAMPLING: dict[tuple[int, int], concurrent.futures.Future] = {}
+"""Resamplings in progress by `id` of `Audio` and target sr, so that only threads that need the same one wait for it."""
 
 
 class Audio:
-    """Holds audio and beats, slicing uses beats."""
-    def __init__(self, audio, sr = None):
+    """Holds audio and beats, slicing uses beats.
+    If `lazy` is True and `audio` is a path, the file isn't loaded, slicing `self.audio` seeks to needed frames and decodes only them.
+    If `lazy` is `"mmap"`, the file is decoded once to an on-disk cache, then the cache is memory-mapped (see `io_.audioread_mmap`)."""
+    def __init__(self, audio, sr = None, lazy: bool | typing.Literal['mmap'] = False):
         if isinstance(audio, str):
-            audio, sr = audioread(audio)
+            if lazy == 'mmap':
+                audio, sr = audioread_mmap(audio)
+            elif lazy:
+                audio = AudioFileReader(audio)
+                sr = audio.sr
+            else:
+                audio, sr = audioread(audio)
 
         else:
-            audio = tonumpy(audio)
+            # everything is float32 like audio decoded by pedalboard so that mixing doesn't upcast
+            audio = tonumpy(audio).astype(np.float32, copy = False)
             if sr is None: sr = 44100
 
         self.audio: np.ndarray = audio
         self.sr = sr
         self.beats: np.ndarray | None = None
+        self.downbeats: np.ndarray | None = None
         self._cur_beat = 0
+        self._hash: str | None = None
+        self._median: tuple[np.ndarray, int] | None = None
+        self._features: BeatFeatures | None = None
+        self._resampled: dict[int, "Audio"] = {}
+        # if this audio was made by `resampled`, beats of the original audio that `self.beats` were rescaled from
+        self._rescaled_from: np.ndarray | None = None
+
+    @property
+    def hash(self) -> str:
+        """Hash of the audio and sample rate, used as a key for caches."""
+        if self._hash is None: self._hash = audio_hash(self.audio, self.sr)
+        return self._hash
+
+    @property
+    def features(self) -> BeatFeatures:
+        """Statistics of every beat like loudness, cached in the beat cache."""
+        if self._features is None: self._features = BeatFeatures(self, cache = BEAT_CACHE)
+        return self._features
+
+    def detect_beats(self, dbn = True, checkpoint = "final0", cache: DiskCache | None = BEAT_CACHE, fixed_bpm = True):
+        """Detects beats, or loads them from `cache` if this audio was already processed with same settings."""
+        with profiling.section('detection', checkpoint):
+            self.beats, self.downbeats = detect_beats_and_downbeats(
+                self.audio, self.sr, dbn = dbn, checkpoint = checkpoint, cache = cache,
+                hash = self.hash if cache is not None else None, fixed_bpm = fixed_bpm,
+            )
+
+    def resampled(self, sr: int, cache: DiskCache | None = RESAMPLE_CACHE) -> "Audio":
+        """Returns this audio resampled to `sr` (see `resample.resample`) with beats rescaled to match, or this audio if it already has that sr.
+        The result is kept, so each sample rate is computed once per `Audio`, and stored in `cache`. Lazy audio is decoded fully."""
+        if sr == self.sr: return self
+        audio = self._resampled.get(sr, None)
+        if audio is None:
+            with _RESAMPLE_LOCK:
+                audio = self._resampled.get(sr, None)
+                future = _RESAMPLING.get((id(self), sr), None)
+                owner = audio is None and future is None
+                if owner: future = _RESAMPLING[(id(self), sr)] = concurrent.futures.Future()
+
+            if owner:
+                try:
+                    audio = self._resample(sr, cache)
+                    self._resampled[sr] = audio
+                    future.set_result(audio) # type:ignore
+                except BaseException as e:
+                    future.set_exception(e) # type:ignore
+                    raise
+                finally:
+                    with _RESAMPLE_LOCK: del _RESAMPLING[(id(self), sr)]
+            elif audio is None: audio = future.result() # type:ignore
+
+        # beats can be detected or reassigned after resampling
+        if self.beats is not None and audio._rescaled_from is not self.beats:
+            scale = sr / self.sr
+            audio.beats = np.asarray(self.beats, dtype = np.float64) * scale
+            audio.downbeats = np.asarray(self.downbeats, dtype = np.float64) * scale if self.downbeats is not None else None
+            audio._rescaled_from = self.beats
+        return audio
+
+    def _resample(self, sr: int, cache: DiskCache | None) -> "Audio":
+        key = make_key('resample', self.hash, sr)
+        cached = cache.get(key) if cache is not None else None
+        if cached is not None: array = cached['audio']
+        else:
+            with profiling.section('resample', f'{self.sr} -> {sr}'):
+                array = resample(np.asarray(self.audio, dtype = np.float32), self.sr, sr)
+            if cache is not None: cache.set(key, audio = array)
+
+        audio = Audio(array, sr)
+        audio._hash = key
+        return audio
+
+    def median_beat_length(self) -> int:
+        """Returns median distance between beats in samples."""
+        if self.beats is None: raise ValueError('This Audio object has no beats')
+        # beats can be reassigned, so the cached value is only used while it is the same array
+        if self._median is None or self._median[0] is not self.beats:
+            self._median = (self.beats, int(np.median(np.diff(self.beats))) if len(self.beats) > 1 else 0)
+        return self._median[1]
+
+    def beat_to_sample(self, beat: int | float) -> int:
+        """Returns position of `beat` in samples, `beat` can be fractional."""
+        if self.beats is None: raise ValueError('This Audio object has no beats')
+        return int(interpolate(self.beats, beat))
+
+    def beats_to_samples(self, beats: abc.Sequence[float] | np.ndarray) -> np.ndarray:
+        """Vectorized `beat_to_sample`, returns positions of all `beats` in samples as an int64 array.
+        Like `beat_to_sample`, positions past the last beat are clamped to the last beat."""
+        if self.beats is None: raise ValueError('This Audio object has no beats')
+        beats = np.asarray(beats, dtype = np.float64)
+        if np.any(beats < 0): raise ValueError(beats[beats < 0])
+        return np.interp(beats, np.arange(len(self.beats)), self.beats).astype(np.int64)
 
-    def detect_beats(self):
-        self.beats = detect_beat_this(self.audio, self.sr)
+    def slice_many(self, starts: abc.Sequence[float] | np.ndarray, stops: abc.Sequence[float] | np.ndarray) -> list[np.ndarray]:
+        """Returns views of `self.audio` from each of `starts` to each of `stops` beats, resolving all positions at once. Don't modify them."""
+        bounds = self.beats_to_samples(np.concatenate([np.asarray(starts, dtype = np.float64), np.asarray(stops, dtype = np.float64)]))
+        starts, stops = np.split(bounds, 2)
+        return [self.audio[:, start:stop] for start, stop in zip(starts.tolist(), stops.tolist())]
 
     def __getitem__(self, s: int | float | slice | abc.Iterable[int | float | slice | abc.Iterable]) -> np.ndarray:
         if self.beats is None:
@@ -39,12 +155,16 @@ class Audio:
             stop_idx = s+1
 
         else:
+            s = list(s)
+            if all(isinstance(beat, (int, float)) for beat in s):
+                starts = np.asarray(s, dtype = np.float64)
+                return np.concatenate(self.slice_many(starts, starts + 1), axis = 1)
             return np.concatenate([self[beat] for beat in s], axis = 1)
 
-        if start_idx is not None: start = int(interpolate(self.beats, start_idx))
+        if start_idx is not None: start = self.beat_to_sample(start_idx)
         else: start = None
 
-        if stop_idx is not None: stop = int(interpolate(self.beats, stop_idx))
+        if stop_idx is not None: stop = self.beat_to_sample(stop_idx)
         else: stop = None
 
         return self.audio[:, start:stop].copy()
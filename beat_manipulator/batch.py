@@ -0,0 +1,102 @@
+"""Renders many `(song, pattern)` jobs on a process pool, use `python -m beat_manipulator manifest.json` from command line.
+
+A job is a dictionary with `song` (path), `pattern` (pattern dictionary, or a string like `1, 3, 2, 4` which also uses `increment`),
+`output` (path that the result is written to) and optionally `sr`, `output_sr` and `seed`. Jobs with `seed` are cached (see `render_cache`)."""
+import argparse
+import concurrent.futures
+import json
+import os
+import time
+import traceback
+import typing
+from collections import abc
+
+from .audio import Audio
+from .beat_detection import get_detector
+from .beatswap_ import beatswap_dict, parse_pattern
+
+
+def load_manifest(path: str) -> list[dict[str, typing.Any]]:
+    """Loads jobs from a JSON file with a list of jobs, or a JSON lines file with one job per line."""
+    with open(path, 'r', encoding = 'utf8') as f:
+        if path.endswith('.jsonl'): return [json.loads(line) for line in f if line.strip()]
+        return json.load(f)
+
+
+def detect_sources(songs: abc.Iterable[str], device: str | None = None) -> dict[str, str]:
+    """Detects beats of all unique `songs` with one model and saves them to the beat cache, so that jobs that use the same song
+    don't detect beats again. Returns tracebacks of songs that failed, jobs with them then fail when they run."""
+    detector = get_detector(device = device)
+    errors = {}
+    for song in dict.fromkeys(songs):
+        try: detector.detect_many([Audio(song, lazy = True)])
+        except Exception: # pylint:disable=W0718
+            errors[song] = traceback.format_exc()
+    return errors
+
+
+def run_job(job: dict[str, typing.Any]) -> str:
+    """Renders a single job and writes it to `job['output']`, returns the output path."""
+    os.makedirs(os.path.dirname(os.path.abspath(job['output'])), exist_ok = True)
+    pattern = job['pattern']
+    if isinstance(pattern, str): pattern = parse_pattern(pattern, job.get('increment', 0))
+    return beatswap_dict(job['song'], pattern, sr = job.get('sr', None), output = job['output'], seed = job.get('seed', None),
+                         output_sr = job.get('output_sr', None))
+
+
+def _run_job(job: dict[str, typing.Any]) -> dict[str, typing.Any]:
+    """Runs `job` and returns the result instead of raising errors, so that a failed job doesn't stop other jobs."""
+    start = time.perf_counter()
+    try:
+        output = run_job(job)
+        error = None
+    except Exception: # pylint:disable=W0718
+        output = None
+        error = traceback.format_exc()
+    return {'job': job, 'output': output, 'error': error, 'time': time.perf_counter() - start}
+
+
+def run_batch(
+    jobs: abc.Sequence[dict[str, typing.Any]],
+    workers: int | None = None,
+    detect: bool = True,
+    device: str | None = None,
+) -> abc.Iterator[dict[str, typing.Any]]:
+    """Renders `jobs` on `workers` processes (number of CPUs by default), yields results as jobs finish.
+    Each result is a dictionary with `job`, `output`, `error` (traceback or None) and `time` in seconds.
+
+    If `detect` is True, beats of all songs are detected first in this process, so the model is loaded once
+    and each song is only processed once no matter how many jobs use it."""
+    if detect:
+        # jobs without a song fail in `_run_job`
+        detect_sources((job['song'] for job in jobs if isinstance(job.get('song', None), str)), device = device)
+
+    if workers == 1:
+        for job in jobs: yield _run_job(job)
+        return
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers = workers) as executor:
+        futures = [executor.submit(_run_job, job) for job in jobs]
+        for future in concurrent.futures.as_completed(futures):
+            yield future.result()
+
+
+def main(argv: abc.Sequence[str] | None = None):
+    parser = argparse.ArgumentParser(prog = 'beat_manipulator', description = 'Renders jobs from a JSON or JSON lines manifest.')
+    parser.add_argument('manifest', help = 'path to a JSON file with a list of jobs, or a JSON lines file with one job per line')
+    parser.add_argument('-j', '--workers', type = int, default = None, help = 'number of worker processes, defaults to number of CPUs')
+    parser.add_argument('--no-detect', action = 'store_true', help = "don't detect beats of all songs before rendering")
+    parser.add_argument('--device', default = None, help = 'device for beat detection, picked automatically by default')
+    args = parser.parse_args(argv)
+
+    jobs = load_manifest(args.manifest)
+    failed = 0
+    for result in run_batch(jobs, workers = args.workers, detect = not args.no_detect, device = args.device):
+        if result['error'] is None:
+            print(f"{result['output']} ({result['time']:.2f}s)")
+        else:
+            failed += 1
+            print(f"FAILED {result['job'].get('output')}:\n{result['error']}")
+
+    print(f'{len(jobs) - failed}/{len(jobs)} jobs finished')
+    return 1 if failed > 0 else 0
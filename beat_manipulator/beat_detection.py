@@ -1,14 +1,117 @@
+import os
+import threading
+import typing
+from collections import abc
+
+from .cache import CACHE_DIR, DiskCache, make_key
 from .postprocessing import downbeat_consistency_fixedBPM, beats_from_downbeats
-from .utils import totensor
+from .utils import audio_hash
 import numpy as np
 
-def detect_beat_this(audio, sr, dbn=True):
+if typing.TYPE_CHECKING:
+    from .audio import Audio
+
+BEAT_CACHE = DiskCache(os.path.join(CACHE_DIR, 'beats'), max_bytes = 64 * 2**20)
+"""Beats and downbeats of every track that was detected, keyed by hash of decoded audio and detection settings."""
+
+def default_device() -> str:
+    """Returns `cuda` or `mps` if available, otherwise `cpu`."""
+    import torch
+    if torch.cuda.is_available(): return 'cuda'
+    mps = getattr(torch.backends, 'mps', None)
+    if mps is not None and mps.is_available(): return 'mps'
+    return 'cpu'
+
+
+class BeatDetector:
+    """Detects beats with `beat_this`. The model is loaded on first use and then reused for all detections,
+    use `get_detector` to get a detector shared by the whole process.
+
+    If `fixed_bpm` is True, beats are replaced with a grid of median downbeat length (see `downbeat_consistency_fixedBPM`)."""
+    def __init__(self, checkpoint = "final0", dbn = True, device: str | None = None, fixed_bpm = True):
+        self.checkpoint = checkpoint
+        self.dbn = dbn
+        self.fixed_bpm = fixed_bpm
+        self.device = device
+        self._model = None
+        self._lock = threading.Lock()
+
+    @property
+    def model(self):
+        if self._model is None:
+            # threads that detect different tracks at the same time load the model once
+            with self._lock:
+                if self._model is None:
+                    from beat_this.inference import Audio2Beats
+                    if self.device is None: self.device = default_device()
+                    self._model = Audio2Beats(checkpoint_path=self.checkpoint, device=self.device, dbn=self.dbn)
+        return self._model
+
+    def _key(self, hash: str, sr: int):
+        return make_key(hash, sr, self.dbn, self.checkpoint, self.fixed_bpm)
+
+    def _infer(self, audio: np.ndarray, sr: int):
+        beats, downbeats = self.model(np.asarray(audio).T, sr)
+        beats = np.array(beats)*sr
+        downbeats = np.array(downbeats)*sr
+        if self.fixed_bpm and len(downbeats) >= 2: beats, downbeats = downbeat_consistency_fixedBPM(audio, downbeats)
+        return beats, downbeats
+
+    def detect(self, audio: np.ndarray, sr: int, cache: DiskCache | None = BEAT_CACHE, hash: str | None = None) -> tuple[np.ndarray, np.ndarray]:
+        """Returns beat positions and downbeat positions in samples.
+        If `cache` is specified, looks up the beats there first and saves newly detected beats to it.
+        `hash` is `utils.audio_hash` of the audio, pass it if it is already known to avoid hashing again."""
+        if cache is None: return self._infer(audio, sr)
+
+        if hash is None: hash = audio_hash(audio, sr)
+        key = self._key(hash, sr)
+
+        cached = cache.get(key)
+        if cached is not None: return cached['beats'], cached['downbeats']
+
+        beats, downbeats = self._infer(audio, sr)
+        cache.set(key, beats = beats, downbeats = downbeats)
+        return beats, downbeats
+
+    def detect_many(self, audios: "abc.Iterable[Audio]", cache: DiskCache | None = BEAT_CACHE):
+        """Detects beats of all `Audio` objects and sets their `beats` and `downbeats`.
+        Tracks that are cached or have the same content as another track are only processed once,
+        the rest run back to back on the same model with gradients disabled. Torch is only imported if some tracks aren't cached."""
+        todo: dict[tuple[str, int], list[Audio]] = {}
+        for audio in audios:
+            if cache is not None:
+                cached = cache.get(self._key(audio.hash, audio.sr))
+                if cached is not None:
+                    audio.beats, audio.downbeats = cached['beats'], cached['downbeats']
+                    continue
+            todo.setdefault((audio.hash, audio.sr), []).append(audio)
+
+        if len(todo) == 0: return
+        import torch
+        with torch.inference_mode():
+            for (hash, sr), same in todo.items():
+                beats, downbeats = self._infer(same[0].audio, sr)
+                if cache is not None: cache.set(self._key(hash, sr), beats = beats, downbeats = downbeats)
+                for audio in same: audio.beats, audio.downbeats = beats, downbeats
+
+
+_DETECTORS: dict[tuple, BeatDetector] = {}
+_DETECTORS_LOCK = threading.Lock()
+
+def get_detector(checkpoint = "final0", dbn = True, device: str | None = None, fixed_bpm = True) -> BeatDetector:
+    """Returns a `BeatDetector` that is shared by the whole process for given settings."""
+    key = (checkpoint, dbn, device, fixed_bpm)
+    with _DETECTORS_LOCK:
+        if key not in _DETECTORS: _DETECTORS[key] = BeatDetector(checkpoint = checkpoint, dbn = dbn, device = device, fixed_bpm = fixed_bpm)
+        return _DETECTORS[key]
+
+
+def detect_beats_and_downbeats(audio, sr, dbn=True, checkpoint="final0", cache: DiskCache | None = BEAT_CACHE, hash: str | None = None, fixed_bpm = True):
+    """Detects beats with `beat_this`, returns beat positions and downbeat positions in samples.
+    If `cache` is specified, looks up the beats there first and saves newly detected beats to it.
+    `hash` is `utils.audio_hash` of the audio, pass it if it is already known to avoid hashing again."""
+    return get_detector(checkpoint = checkpoint, dbn = dbn, fixed_bpm = fixed_bpm).detect(audio, sr, cache = cache, hash = hash)
+
+def detect_beat_this(audio, sr, dbn=True, checkpoint="final0", cache: DiskCache | None = BEAT_CACHE, fixed_bpm = True):
     """Detects beats with `beat_this`, returns list of beat positions in samples."""
-    from beat_this.inference import Audio2Beats
-
-    audio2beats = Audio2Beats(checkpoint_path="final0", device="cuda", dbn=dbn)
-    beats, downbeats = audio2beats(totensor(audio.T), sr)
-    beats = np.array(beats)*sr
-    downbeats = np.array(downbeats)*sr
-    #beats, downbeats = downbeat_consistency_fixedBPM(audio, np.array(downbeats)*sr)
-    return beats
\ No newline at end of file
+    return detect_beats_and_downbeats(audio, sr, dbn=dbn, checkpoint=checkpoint, cache=cache, fixed_bpm=fixed_bpm)[0]
@@ -1,3 +1,7 @@
+import concurrent.futures
+import os
+import random
+import time
 import typing
 from collections import abc
 from collections import OrderedDict
@@ -6,39 +10,158 @@ import numpy as np
 
 
 from .operations.beat import operation_beat
+from .operations.variable import operation_create_variable
 from .audio import Audio
+from .beat_detection import get_detector
+from .io_ import audiowriter
+from .plan import Mode, Plan
+from .cache import DiskCache
+from .profiling import Profiler, activate
+from . import render_cache
+from .render_cache import RENDER_CACHE, render_key
+from .timeline import Segment, render, split_overlays
 
-OPERATIONS = {"beat": operation_beat}
+OPERATIONS = {"beat": operation_beat, "create variable": operation_create_variable}
 
 class Beatswap:
-    def __init__(self, pattern: dict[typing.Any, dict[str, typing.Any]], sources: dict[typing.Any, typing.Any]):
+    """If `lazy` is True, sources that are given as paths are not loaded, only the frames that are used get decoded.
+    If `lazy` is `"mmap"`, they are decoded once to an on-disk cache which is then memory-mapped.
+
+    `timings` has time in seconds that was spent compiling the pattern (`compile`) and running it (`run`).
+
+    If `profiler` is specified, time spent in each pattern key, operation, length mode, effect, beat detection and rendering is recorded to it.
+
+    If `fade` is more than 0, every boundary between beats is faded out and in over `fade` samples to remove clicks.
+
+    `seed` is the seed of `self.rng` which is used for shuffles and random variables, renders with the same seed are the same.
+
+    `sr` is the output sample rate, sources with other sample rates are resampled to it once (see `Audio.resampled`) and their beats are rescaled.
+    By default it is the sample rate of `__main_audio__`, or of the first source that is used if there is no main audio."""
+    def __init__(
+        self,
+        pattern: dict[typing.Any, dict[str, typing.Any]],
+        sources: dict[typing.Any, typing.Any],
+        lazy = False,
+        profiler: Profiler | None = None,
+        fade: int = 0,
+        seed = None,
+        sr: int | None = None,
+    ):
         self.pattern = OrderedDict(pattern)
-        self._current_key = list(self.pattern.keys())[0]
 
-        self.beats:list[np.ndarray] = []
-        self._overflow: np.ndarray | None = None
-        self._mul_overflow: np.ndarray | None = None
+        start = time.perf_counter()
+        self.plan = Plan(self.pattern, OPERATIONS)
+        self.timings = {'compile': time.perf_counter() - start, 'run': 0.}
+
+        self.beats: list[Segment] = []
+        self._overflow: list[tuple[Segment, int, int]] = []
+        self._mul_overflow: list[tuple[Segment, int, int]] = []
         self._can_continue = True
         self._variables = {}
+        self._n_written = 0
 
         self._sources: dict[typing.Any, typing.Any] = sources
+        self.lazy = lazy
+        self.profiler = profiler
+        self.fade = fade
+        self.seed = seed
+        self.rng = random.Random(seed)
+
+        main = sources.get('__main_audio__', None)
+        if sr is None and isinstance(main, Audio): sr = main.sr
+        # if still None, set when the first source is used
+        self.sr: int | None = sr
+        # set when first beats are rendered by `iter_blocks`
+        self._channels: int | None = None
 
     def step(self):
-        op = self.pattern[self._current_key]
+        step = self.plan.steps[self.plan.current]
+        if self.profiler is None:
+            self._can_continue = step.operation(self, step)
+            return
+
+        other = [('operation', step.op.get('operation', 'beat'))]
+        if step.mode in (Mode.ADD, Mode.MULTIPLY): other.append(('length mode', step.length_mode.value))
+        with self.profiler.section('key', step.key, other):
+            self._can_continue = step.operation(self, step)
 
-        # perform the operation
-        operation_type = op.get('operation', 'beat')
-        self._can_continue = OPERATIONS[operation_type](self, self.pattern, self._current_key)
+    def _render(self, segments: list[Segment], **kwargs):
+        if self.profiler is None: return render(segments, **kwargs)
+        with self.profiler.section('render', 'render'): return render(segments, **kwargs)
 
     def run(self):
-        while self._can_continue:
-            self.step()
+        start = time.perf_counter()
+        with activate(self.profiler):
+            while self._can_continue:
+                self.step()
+
+            audio = self._render(self.beats, fade = self.fade)
+        self.timings['run'] += time.perf_counter() - start
+        return audio
+
+    def _take(self, n: int, dtype) -> np.ndarray:
+        """Renders first `n` beats and removes them. All blocks have the number of channels of the first one."""
+        if self._channels is None:
+            self._channels = max(s.audio.shape[0] for s in self.beats[:n])
 
-        return np.concatenate(self.beats, axis = 1)
+        split_overlays(self.beats, n)
+        # start and end are faded when there are beats before and after them
+        edges = (self._n_written > 0, n < len(self.beats))
+        block = self._render(self.beats[:n], dtype = dtype, channels = self._channels, fade = self.fade, fade_edges = edges)
+        del self.beats[:n]
+        self._n_written += n
+        return block
 
+    def iter_blocks(self, max_seconds: float | None = None, max_beats: int | None = None, dtype = np.float32) -> abc.Iterator[np.ndarray]:
+        """Runs the pattern and yields `(channels, samples)` blocks of output as soon as no operation in the pattern can change them,
+        so the first block is available after a few beats. Blocks are usually one beat long, but patterns with `prepend`
+        or `insert` to positive indexes can only yield everything at the end.
 
-def beatswap(song, pattern:str, increment: float, sr = None):
-    """Temporary simple pattern parser for testing"""
+        Stops after `max_seconds` of output or `max_beats` beats if they are specified, e.g. to preview the start of a render.
+        The pattern runs until those beats are final, so the output is the start of the full render."""
+        last, first = self.plan.mutable_beats()
+        produced = 0
+
+        while True:
+            start = time.perf_counter()
+            with activate(self.profiler):
+                done = not self._can_continue
+                if done: n = len(self.beats)
+                else:
+                    self.step()
+                    n = min(len(self.beats) - last, first - self._n_written)
+                    # with fades the last beat is kept until the next one is known, otherwise its end would be faded
+                    if self.fade > 0: n = min(n, len(self.beats) - 1)
+
+                if max_beats is not None: n = min(n, max_beats - self._n_written)
+                block = self._take(n, dtype) if n > 0 else None # type:ignore
+            self.timings['run'] += time.perf_counter() - start
+
+            if block is not None:
+                if max_seconds is not None: block = block[:, :max(int(max_seconds * self.sr) - produced, 0)] # type:ignore
+                produced += block.shape[1]
+                if block.shape[1] > 0: yield block
+
+            if max_beats is not None and self._n_written >= max_beats: return
+            if max_seconds is not None and self.sr is not None and produced >= int(max_seconds * self.sr): return
+            if done: return
+
+    def run_to_file(self, path: str, max_seconds: float | None = None, max_beats: int | None = None) -> str:
+        """Runs the pattern and writes beats to `path` as soon as no operation in the pattern can change them,
+        so memory usage doesn't depend on length of the output. Returns `path`."""
+        writer = None
+        try:
+            for block in self.iter_blocks(max_seconds = max_seconds, max_beats = max_beats):
+                if writer is None: writer = audiowriter(path, self.sr, block.shape[0]) # type:ignore
+                writer.write(block)
+        finally:
+            if writer is not None: writer.close()
+
+        return path
+
+
+def parse_pattern(pattern: str, increment: float) -> OrderedDict:
+    """Temporary simple pattern parser for testing, converts pattern like `1, 3, 2:3, 4` to a pattern dictionary."""
     beats = pattern.replace(' ', '').split(',')
     ops = OrderedDict()
     for i, b in enumerate(beats):
@@ -47,10 +170,150 @@ def beatswap(song, pattern:str, increment: float, sr = None):
             ops[i] = {"start": float(start), "stop": float(stop), "increment": increment}
         else:
             ops[i] = {"start": float(b), "increment": increment}
+    return ops
+
+def beatswap(
+    song,
+    pattern:str,
+    increment: float,
+    sr = None,
+    output: str | None = None,
+    fade: int = 0,
+    seed = None,
+    cache: DiskCache | None = RENDER_CACHE,
+    output_sr: int | None = None,
+):
+    """Temporary simple pattern parser for testing. If `output` is specified, writes to that file instead of returning an array."""
+    ops = parse_pattern(pattern, increment)
+    return beatswap_dict(song, ops, sr = sr, output = output, fade = fade, seed = seed, cache = cache, output_sr = output_sr)
+
+def beatswap_dict(
+    song,
+    pattern:dict,
+    sr = None,
+    output: str | None = None,
+    fade: int = 0,
+    seed = None,
+    cache: DiskCache | None = RENDER_CACHE,
+    output_sr: int | None = None,
+):
+    """If `output` is specified, writes to that file with bounded memory usage instead of returning an array.
+    `fade` is length in samples of fades at boundaries between beats. `sr` is sample rate of `song` if it is an array,
+    `output_sr` is sample rate of the output, by default the sample rate of `song`.
+
+    If `seed` is specified, the render is deterministic, and it is stored in `cache`, or loaded from it without running the pattern
+    if the same sources were already rendered with the same pattern and seed."""
+    lazy = output is not None
+    sources = load_sources({"__main_audio__": song}, [pattern], sr = sr, lazy = lazy)
+    return render_sources(sources, pattern, output = output, fade = fade, seed = seed, cache = cache, lazy = lazy, output_sr = output_sr)
+
+def render_sources(
+    sources: dict[typing.Any, Audio],
+    pattern: dict,
+    output: str | None = None,
+    fade: int = 0,
+    seed = None,
+    cache: DiskCache | None = RENDER_CACHE,
+    lazy = False,
+    output_sr: int | None = None,
+):
+    """Renders `pattern` with already loaded `sources`, see `beatswap_dict`."""
+    key = None
+    if cache is not None:
+        file_format = os.path.splitext(output)[1].lower() if output is not None else None
+        key = render_key(sources, pattern, seed, fade = fade, file_format = file_format, sr = output_sr)
+
+    if output is None:
+        if key is not None:
+            audio = render_cache.get_array(key, cache) # type:ignore
+            if audio is not None: return audio
+
+        audio = Beatswap(pattern, sources, fade = fade, seed = seed, sr = output_sr).run()
+        if key is not None: render_cache.set_array(key, audio, cache) # type:ignore
+        return audio
+
+    if key is not None and render_cache.get_file(key, output, cache) is not None: return output # type:ignore
+    Beatswap(pattern, sources, lazy = lazy, fade = fade, seed = seed, sr = output_sr).run_to_file(output)
+    if key is not None: render_cache.set_file(key, output, cache) # type:ignore
+    return output
+
+
+
+def load_sources(sources: dict[typing.Any, typing.Any], patterns: abc.Iterable[dict[typing.Any, dict[str, typing.Any]]], sr = None, lazy = False):
+    """Converts all sources to `Audio`, including ones that are only referenced by path in patterns."""
+    sources = dict(sources)
+    for pattern in patterns:
+        for op in pattern.values():
+            name = op.get('source', '__main_audio__')
+            if name not in sources: sources[name] = name
+
+    for name, source in sources.items():
+        if not isinstance(source, Audio): sources[name] = Audio(source, sr if name == '__main_audio__' else None, lazy = lazy)
+    return sources
+
+
+def prepare_sources(sources: dict[typing.Any, typing.Any], patterns: abc.Iterable[dict[typing.Any, dict[str, typing.Any]]], sr = None):
+    """Loads all sources that `patterns` use, including ones that are only referenced by path in patterns,
+    and detects beats of sources that are sliced by beats, so that `Beatswap` objects can share them without modifying them."""
+    patterns = list(patterns)
+    sources = load_sources(sources, patterns, sr = sr)
+    beat_sources = set()
+    for pattern in patterns:
+        for op in pattern.values():
+            if op.get('source mode', 'beats') == 'beats': beat_sources.add(op.get('source', '__main_audio__'))
+
+    detect = [sources[name] for name in beat_sources if sources[name].beats is None]
+    if len(detect) > 0: get_detector().detect_many(detect)
+
+    # hash is computed lazily, compute it now so that threads don't do it at the same time
+    for audio in sources.values(): audio.hash # pylint:disable=W0104
+    return sources
+
+
+_WORKER_SOURCES: dict[typing.Any, Audio] = {}
+"""Sources of a process started by `beatswap_many`, sent once per process instead of once per pattern."""
+
+def _init_worker(sources: dict[typing.Any, Audio]):
+    global _WORKER_SOURCES # pylint:disable=W0603
+    _WORKER_SOURCES = sources
+
+def _render(pattern: dict, sources: dict[typing.Any, Audio] | None = None, seed = None, output_sr: int | None = None):
+    # each Beatswap gets its own dictionary because it adds sources to it, Audio objects are shared
+    return Beatswap(pattern, dict(sources if sources is not None else _WORKER_SOURCES), seed = seed, sr = output_sr).run()
+
+def beatswap_many(
+    song,
+    patterns: abc.Sequence[dict | str] | dict[typing.Any, dict | str],
+    increment: float = 0,
+    sr = None,
+    sources: dict[typing.Any, typing.Any] | None = None,
+    workers: int | None = None,
+    processes = False,
+    seed = None,
+    output_sr: int | None = None,
+) -> abc.Iterator[tuple[typing.Any, np.ndarray]]:
+    """Renders many patterns with the same sources, yields `(key, audio)` as each pattern finishes,
+    where key is the index of the pattern, or its key if `patterns` is a dictionary. Patterns can be strings, then they use `increment`.
+
+    `song` is decoded and its beats are detected once. If `sources` is specified, they are used by all patterns as well.
+    Patterns are rendered on `workers` threads, or processes if `processes` is True, then sources are copied once to each process.
+    Each pattern is rendered with its own `random.Random(seed)`. Sources are resampled to `output_sr` once and shared if it is specified."""
+    if not isinstance(patterns, dict): patterns = dict(enumerate(patterns))
+    patterns = {k: parse_pattern(p, increment) if isinstance(p, str) else p for k, p in patterns.items()}
+
+    sources = dict(sources) if sources is not None else {}
+    if song is not None: sources['__main_audio__'] = song
+    sources = prepare_sources(sources, patterns.values(), sr = sr)
+    if output_sr is None: output_sr = sources['__main_audio__'].sr if '__main_audio__' in sources else None
+    # resampled before rendering so that threads don't resample the same source at the same time
+    if output_sr is not None:
+        for audio in sources.values(): audio.resampled(output_sr)
 
-    bs = Beatswap(ops, {"__main_audio__": Audio(song, sr)})
-    return bs.run()
+    if processes: executor = concurrent.futures.ProcessPoolExecutor(workers, initializer = _init_worker, initargs = (sources, ))
+    else: executor = concurrent.futures.ThreadPoolExecutor(workers)
 
-def beatswap_dict(song, pattern:dict, sr = None):
-    bs = Beatswap(pattern, {"__main_audio__": Audio(song, sr)})
-    return bs.run()
+    with executor:
+        if processes: futures = {executor.submit(_render, pattern, None, seed, output_sr): key for key, pattern in patterns.items()}
+        else: futures = {executor.submit(_render, pattern, sources, seed, output_sr): key for key, pattern in patterns.items()}
+        for future in concurrent.futures.as_completed(futures):
+            yield futures[future], future.result()
\ No newline at end of file
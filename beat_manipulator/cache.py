@@ -0,0 +1,96 @@
+"""On-disk caches."""
+import hashlib
+import os
+import tempfile
+from collections import abc
+
+import numpy as np
+
+CACHE_DIR = os.environ.get('BEAT_MANIPULATOR_CACHE', os.path.join(os.path.expanduser('~'), '.cache', 'beat_manipulator'))
+
+
+def make_key(*parts) -> str:
+    """Hashes `repr` of all parts into a key."""
+    return hashlib.sha1(repr(parts).encode()).hexdigest()
+
+
+def canonical(value):
+    """Converts lists, dicts and numpy scalars to a hashable form so that equal arguments give equal keys."""
+    if isinstance(value, dict): return tuple(sorted((str(k), canonical(v)) for k, v in value.items()))
+    if isinstance(value, (list, tuple)): return tuple(canonical(v) for v in value)
+    if isinstance(value, np.generic): return value.item()
+    return value
+
+
+class DiskCache:
+    """Directory of `.npz` files, evicts least recently used files when total size goes above `max_bytes`.
+    With other `suffix`, use `get_file` and `write` to store files in other formats."""
+    def __init__(self, path: str, max_bytes: int = 2**30, suffix: str = '.npz'):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.suffix = suffix
+
+    def _file(self, key: str):
+        return os.path.join(self.path, f'{key}{self.suffix}')
+
+    def get_file(self, key: str) -> str | None:
+        """Returns path to the file of `key` if it exists, and marks it as recently used."""
+        file = self._file(key)
+        try: os.utime(file)
+        except OSError: return None
+        return file
+
+    def get(self, key: str) -> dict[str, np.ndarray] | None:
+        file = self._file(key)
+        try:
+            with np.load(file) as f: arrays = dict(f)
+        except (OSError, ValueError):
+            return None
+
+        # modification time is used as last access time
+        try: os.utime(file)
+        except OSError: pass
+        return arrays
+
+    def set(self, key: str, **arrays: np.ndarray):
+        self.write(key, lambda f: np.savez(f, **arrays))
+
+    def write(self, key: str, write: abc.Callable) -> str:
+        """Calls `write` with a binary file object to create the file of `key`, returns path to that file."""
+        os.makedirs(self.path, exist_ok=True)
+        file = self._file(key)
+
+        # write to a temporary file and rename so that other processes never read a partial file
+        fd, tmp = tempfile.mkstemp(dir=self.path, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f: write(f)
+            os.replace(tmp, file)
+        except BaseException:
+            os.remove(tmp)
+            raise
+
+        self.evict(keep = file)
+        return file
+
+    def evict(self, keep: str | None = None):
+        """Removes least recently used files until total size is below `max_bytes`, except `keep`."""
+        entries = []
+        with os.scandir(self.path) as it:
+            for entry in it:
+                if not entry.name.endswith(self.suffix): continue
+                try: stat = entry.stat()
+                except OSError: continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes: break
+            if path == keep: continue
+            try: os.remove(path)
+            except OSError: pass
+            total -= size
+
+    def clear(self):
+        if not os.path.isdir(self.path): return
+        for name in os.listdir(self.path):
+            if name.endswith(self.suffix): os.remove(os.path.join(self.path, name))
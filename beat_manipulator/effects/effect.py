@@ -1,17 +1,29 @@
 """Effects. Note that all of them accept `audio` and `sr` as first 2 args, even if `sr` is not used."""
+import threading
+import typing
+from collections import OrderedDict, abc
+
 import numpy as np
 
-def volume(audio: np.ndarray, sr: int, factor: float):
+from .. import profiling
+from ..cache import canonical
+
+def _out(audio: np.ndarray, out: np.ndarray | None):
+    """Returns `out`, or a new array like `audio` if it is None."""
+    return np.empty_like(audio) if out is None else out
+
+def volume(audio: np.ndarray, sr: int, factor: float, out: np.ndarray | None = None):
     """Multiplies volume"""
-    return audio*factor
+    return np.multiply(audio, factor, out = _out(audio, out))
 
 def speed(audio: np.ndarray, sr: int, factor: float = 2, precision:int = 48):
     """Changes the speed of the audio (if factor is not integer, it will be slightly inexact but fast)."""
     if factor%1 != 0 and (1/factor)%1 != 0:
         import fractions
         frac = fractions.Fraction(factor).limit_denominator(precision)
-        audio = np.repeat(audio, frac.denominator, axis=1)
-        return audio[:,::frac.numerator]
+        # same as repeating each sample `denominator` times and taking every `numerator`-th sample
+        index = np.arange(0, audio.shape[1] * frac.denominator, frac.numerator) // frac.denominator
+        return np.take(audio, index, axis=1)
 
     elif factor%1 == 0:
         return audio[:,::int(factor)]
@@ -19,56 +31,84 @@ def speed(audio: np.ndarray, sr: int, factor: float = 2, precision:int = 48):
     else:
         return np.repeat(audio, int(1/factor), axis=1)
 
-def channel(audio: np.ndarray, sr: int, ch:int | None = None):
+def channel(audio: np.ndarray, sr: int, ch:int | None = None, out: np.ndarray | None = None):
     """If c is None, swaps channels. Otherwise zeroes `ch` channel."""
+    out = _out(audio, out)
     if ch is None:
-        audio[0], audio[1] = audio[1], audio[0]
-        return audio
+        out[[0, 1]] = audio[[1, 0]]
+        out[2:] = audio[2:]
+        return out
 
-    audio[ch] = 0
-    return audio
+    if out is not audio: out[:] = audio
+    out[ch] = 0
+    return out
+
+def downsample(audio: np.ndarray, sr: int, factor:int = 10, out: np.ndarray | None = None):
+    """Downsample by a factor of `d`. `out` is only used if length of the audio is divisible by `factor`."""
+    samples = audio[:,::factor]
+    if out is None or samples.shape[1] * factor != out.shape[1]:
+        out = np.empty((audio.shape[0], samples.shape[1] * factor), dtype = audio.dtype)
+    out.reshape(audio.shape[0], -1, factor)[:] = samples[:, :, None]
+    return out
 
-def downsample(audio: np.ndarray, sr: int, factor:int = 10):
-    """Downsample by a factor of `d`"""
-    return np.repeat(audio[:,::factor], factor, axis=1)
+def _gradient(audio: np.ndarray, out: np.ndarray):
+    """`np.gradient(audio, axis=1)` written to `out`, which must not overlap `audio`."""
+    np.subtract(audio[:, 2:], audio[:, :-2], out = out[:, 1:-1])
+    out[:, 1:-1] *= 0.5
+    np.subtract(audio[:, 1], audio[:, 0], out = out[:, 0])
+    np.subtract(audio[:, -1], audio[:, -2], out = out[:, -1])
 
-def gradient(audio: np.ndarray, sr: int, number: int = 1):
+def gradient(audio: np.ndarray, sr: int, number: int = 1, out: np.ndarray | None = None):
     """Takes the gradient of the audio multiple times"""
-    for _ in range(number):
-        audio = np.gradient(audio, axis=1)
-    return audio
+    out = _out(audio, out)
+    if number < 1:
+        if out is not audio: out[:] = audio
+        return out
+    if audio.shape[1] < 2:
+        out.fill(0)
+        return out
 
-def bitcrush(audio: np.ndarray, sr: int, precision:float = 4):
-    """Discretizes the audio to `precision` steps"""
-    return np.around(audio*precision) / precision
+    # passes alternate between `out` and one scratch buffer so that the last one writes to `out`
+    scratch = np.empty_like(out)
+    if number % 2 == 1 and np.shares_memory(audio, out):
+        scratch[:] = audio
+        audio = scratch
 
-def reverse(audio: np.ndarray, sr: int, ):
-    return audio[:,::-1]
+    buffers = (out, scratch) if number % 2 == 1 else (scratch, out)
+    for i in range(number):
+        _gradient(audio, buffers[i % 2])
+        audio = buffers[i % 2]
+    return out
 
-def normalize(audio: np.ndarray, sr: int, ):
-    return audio*(1/np.max(np.abs(audio)))
+def bitcrush(audio: np.ndarray, sr: int, precision:float = 4, out: np.ndarray | None = None):
+    """Discretizes the audio to `precision` steps"""
+    out = np.multiply(audio, precision, out = _out(audio, out))
+    np.around(out, out = out)
+    out /= precision
+    return out
 
-def clip(audio: np.ndarray, sr: int, ):
-    return np.clip(audio, -1, 1)
+def reverse(audio: np.ndarray, sr: int, out: np.ndarray | None = None):
+    if out is None: return audio[:,::-1]
+    out[:] = audio[:,::-1]
+    return out
 
-def pitch(audio: np.ndarray, sr: int, semitones):
-    import pedalboard
-    pitch_shift = pedalboard.PitchShift(semitones)
-    return pitch_shift.process(audio, sample_rate = sr)
+def normalize(audio: np.ndarray, sr: int, out: np.ndarray | None = None):
+    # max of absolute value without allocating `np.abs(audio)`
+    peak = max(audio.max(), -audio.min())
+    return np.multiply(audio, 1/peak, out = _out(audio, out))
 
-def stretch(audio: np.ndarray, sr: int, factor):
+def clip(audio: np.ndarray, sr: int, out: np.ndarray | None = None):
+    return np.clip(audio, -1, 1, out = _out(audio, out))
+
+def _pitch_plugin(semitones):
     import pedalboard
-    return pedalboard.time_stretch(audio, sr, factor, )
+    return pedalboard.PitchShift(semitones)
 
-def compress(audio: np.ndarray, sr: int, vbr_quality:float = 8):
-    """Compresses the audio using mp3 compressor to `vbr_quality` which must be from 0 to 10 (lower = better quality)."""
+def _compress_plugin(vbr_quality: float = 8):
     import pedalboard
-    compressor = pedalboard.MP3Compressor(vbr_quality)
-    return compressor(audio, sr)
+    return pedalboard.MP3Compressor(vbr_quality)
 
-def reverb(
-    audio: np.ndarray,
-    sr: int,
+def _reverb_plugin(
     room_size: float = 0.5,
     damping: float = 0.5,
     wet_level: float = 0.33,
@@ -77,8 +117,7 @@ def reverb(
     freeze_mode: float = 0,
 ):
     import pedalboard
-
-    reverber = pedalboard.Reverb(
+    return pedalboard.Reverb(
         room_size=room_size,
         damping=damping,
         wet_level=wet_level,
@@ -86,7 +125,72 @@ def reverb(
         width=width,
         freeze_mode=freeze_mode,
     )
-    return reverber(audio, sr)
+
+PLUGINS = {
+    "pit": _pitch_plugin,
+    "cmp": _compress_plugin,
+    "rvb": _reverb_plugin,
+}
+"""Effects that are pedalboard plugins, consecutive ones are processed as a single `pedalboard.Pedalboard` by `apply_effects`."""
+
+LATENCY = {"pit", "cmp"}
+"""Plugins that delay their output internally. A board compensates latency of all its plugins at once, which changes the output
+when such plugin follows another plugin, so `apply_effects` only fuses them at the start of a run."""
+
+POOL_SIZE = 64
+"""Number of plugins and of boards kept by each thread, least recently used ones are dropped."""
+
+_pool = threading.local()
+
+def _pooled(name: str, key, create: abc.Callable):
+    """Returns object under `key` in least recently used pool `name` of this thread, creating it with `create` if it isn't there."""
+    pool: OrderedDict = _pool.__dict__.setdefault(name, OrderedDict())
+    if key in pool: pool.move_to_end(key)
+    else:
+        pool[key] = create()
+        while len(pool) > POOL_SIZE: pool.popitem(last = False)
+    return pool[key]
+
+def get_plugin(effect: str, args = (), kwargs = None):
+    """Returns pedalboard plugin of `effect` with given parameters. Plugins are created once per thread and reused,
+    they are reset before processing so reusing them doesn't change the output."""
+    if kwargs is None: kwargs = {}
+    key = (effect, canonical(args), canonical(kwargs))
+    return _pooled('plugins', key, lambda: PLUGINS[effect](*args, **kwargs))
+
+def get_board(effects: abc.Sequence[tuple[str, typing.Any, typing.Any]]):
+    """Returns `pedalboard.Pedalboard` with plugins of all `effects`, which must be in `PLUGINS`.
+    Boards are reused like plugins, each board has its own plugins, so equal effects in one chain don't share state."""
+    def create():
+        import pedalboard
+        return pedalboard.Pedalboard([PLUGINS[effect](*args, **(kwargs or {})) for effect, args, kwargs in effects])
+
+    key = tuple((effect, canonical(args), canonical(kwargs)) for effect, args, kwargs in effects)
+    return _pooled('boards', key, create)
+
+def pitch(audio: np.ndarray, sr: int, semitones):
+    return get_plugin('pit', (semitones, )).process(audio, sample_rate = sr)
+
+def stretch(audio: np.ndarray, sr: int, factor):
+    import pedalboard
+    return pedalboard.time_stretch(audio, sr, factor, )
+
+def compress(audio: np.ndarray, sr: int, vbr_quality:float = 8):
+    """Compresses the audio using mp3 compressor to `vbr_quality` which must be from 0 to 10 (lower = better quality)."""
+    return get_plugin('cmp', (vbr_quality, )).process(audio, sample_rate = sr)
+
+def reverb(
+    audio: np.ndarray,
+    sr: int,
+    room_size: float = 0.5,
+    damping: float = 0.5,
+    wet_level: float = 0.33,
+    dry_level: float = 0.4,
+    width: float = 1,
+    freeze_mode: float = 0,
+):
+    plugin = get_plugin('rvb', (room_size, damping, wet_level, dry_level, width, freeze_mode))
+    return plugin.process(audio, sample_rate = sr)
 
 
 EFFECTS = {
@@ -105,6 +209,117 @@ EFFECTS = {
     "rvb": reverb
 }
 
-def apply_effect(audio, sr, effect, args, kwargs):
+INPLACE = {"vol", "chn", "dwn", "grd", "bcr", "rev", "nrm", "clp"}
+"""Effects that accept `out` argument, which can be the input array itself."""
+
+def apply_effect(audio, sr, effect, args, kwargs, out: np.ndarray | None = None):
+    """Applies `effect`, if `out` is specified, `effect` must be in `INPLACE` and it may write the output to `out`."""
     fn = EFFECTS[effect]
-    return fn(audio, sr, *args, **kwargs)
\ No newline at end of file
+    if out is not None: kwargs = {**kwargs, 'out': out}
+
+    profiler = profiling.active()
+    if profiler is None: return fn(audio, sr, *args, **kwargs)
+    with profiler.section('effect', effect): return fn(audio, sr, *args, **kwargs)
+
+
+NONDETERMINISTIC: set[str] = set()
+"""Effects that can return different outputs for the same input, outputs of effect chains with them are never cached."""
+
+class EffectCache:
+    """Least recently used cache of outputs of effect chains, keeps total size of stored outputs below `max_bytes`.
+    Stored outputs are read-only. It can be used from multiple threads."""
+    def __init__(self, max_bytes: int = 256 * 2**20):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries: OrderedDict[typing.Any, np.ndarray] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key) -> np.ndarray | None:
+        with self._lock:
+            audio = self._entries.get(key, None)
+            if audio is None:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return audio
+
+    def set(self, key, audio: np.ndarray):
+        if audio.nbytes > self.max_bytes: return
+        audio.flags.writeable = False
+
+        with self._lock:
+            if key in self._entries: self.nbytes -= self._entries.pop(key).nbytes
+            self._entries[key] = audio
+            self.nbytes += audio.nbytes
+            while self.nbytes > self.max_bytes:
+                self.nbytes -= self._entries.popitem(last = False)[1].nbytes
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.nbytes = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+EFFECT_CACHE = EffectCache()
+
+
+def effects_key(source, start: int, stop: int, sr: int, effects: abc.Sequence[tuple[str, typing.Any, typing.Any]]):
+    """Key of `effects` applied to `source[:, start:stop]` in `EffectCache`. Returns None if any of the effects is in `NONDETERMINISTIC`.
+    `source` is a hashable identity of the source audio, like `Audio.hash`."""
+    if any(effect in NONDETERMINISTIC for effect, _, _ in effects): return None
+    return (source, start, stop, sr, tuple((effect, canonical(args), canonical(kwargs)) for effect, args, kwargs in effects))
+
+def apply_effects(audio: np.ndarray, sr: int, effects: abc.Sequence[tuple[str, typing.Any, typing.Any]], key = None, cache: EffectCache | None = EFFECT_CACHE):
+    """Applies a chain of `(effect, args, kwargs)` to `audio` without modifying it, runs of effects in `PLUGINS` are fused into one pedalboard
+    when that gives the same output as applying them one by one (see `LATENCY`).
+    Effects in `INPLACE` write to the output of the previous effect, so the chain makes at most one copy of `audio` plus what other effects allocate.
+    Output has the same dtype as `audio`.
+    If `key` is specified (see `effects_key`), output is looked up in and stored to `cache`, and then it must not be modified."""
+    if key is not None and cache is not None:
+        cached = cache.get(key)
+        if cached is not None: return cached
+
+    dtype = audio.dtype
+    # whether `audio` was created here and effects can write to it
+    owned = False
+    i = 0
+    while i < len(effects):
+        effect, args, kwargs = effects[i]
+
+        # consecutive pedalboard effects are processed in one call, a plugin with latency starts a new run
+        j = i
+        while j < len(effects) and effects[j][0] in PLUGINS and (j == i or effects[j][0] not in LATENCY): j += 1
+        if j > i:
+            board = get_board(effects[i:j])
+            profiler = profiling.active()
+            if profiler is None: audio = board.process(audio, sample_rate = sr)
+            else:
+                with profiler.section('effect', '+'.join(e[0] for e in effects[i:j])): audio = board.process(audio, sample_rate = sr)
+            owned = True
+            i = j
+
+        elif effect in INPLACE:
+            out = audio if owned else np.empty_like(audio)
+            audio = apply_effect(audio, sr, effect = effect, args = args, kwargs = kwargs, out = out)
+            owned = True
+            i += 1
+
+        # other effects don't modify their input but can return a view of it
+        else:
+            audio = apply_effect(audio, sr, effect = effect, args = args, kwargs = kwargs)
+            owned = False
+            i += 1
+
+        if audio.dtype != dtype:
+            audio = audio.astype(dtype)
+            owned = True
+
+    if not owned: audio = audio.copy()
+    if key is not None and cache is not None: cache.set(key, audio)
+    return audio
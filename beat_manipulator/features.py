@@ -0,0 +1,118 @@
+"""Statistics of every beat of an `Audio`, computed for all beats at once and cached with the beats."""
+import hashlib
+import typing
+
+import numpy as np
+
+from .cache import DiskCache, make_key
+if typing.TYPE_CHECKING:
+    from .audio import Audio
+
+
+def _abs(audio: np.ndarray, argument, bounds): return np.abs(audio)
+def _signed(audio: np.ndarray, argument, bounds): return audio
+
+def _gradient(audio: np.ndarray, bounds: np.ndarray):
+    """`np.gradient` of every beat from `bounds[i]` to `bounds[i+1]` computed at once, beats shorter than 2 samples are zeros."""
+    out = np.empty_like(audio)
+    out[:, 1:-1] = (audio[:, 2:] - audio[:, :-2]) / 2
+    starts, stops = bounds[:-1], bounds[1:]
+    lengths = stops - starts
+    # one-sided differences at edges of beats, like `np.gradient` at edges of an array
+    s, e = starts[lengths >= 2], stops[lengths >= 2]
+    out[:, s] = audio[:, s + 1] - audio[:, s]
+    out[:, e - 1] = audio[:, e - 1] - audio[:, e - 2]
+    out[:, starts[lengths == 1]] = 0
+    return out
+
+def _abs_gradient(audio: np.ndarray, argument, bounds):
+    for _ in range(int(argument) if argument is not None else 1):
+        audio = _gradient(audio, bounds)
+    return np.abs(audio)
+
+FEATURES: dict[str, tuple[typing.Callable, typing.Any]] = {
+    "average": (_abs, np.add),
+    "mean": (_abs, np.add),
+    "DC offset": (_signed, np.add),
+    "average gradient": (_abs_gradient, np.add),
+    "mean gradient": (_abs_gradient, np.add),
+    "max": (_abs, np.maximum),
+}
+"""Functions that can be used to create variables, as `(transform, reduction)`. Each beat is reduced with `reduction` after `transform`,
+`np.add` gives the mean. `transform(audio, argument, bounds)` gets consecutive beats with bounds of each beat, and must treat every beat separately."""
+
+
+def beat_features(audio: np.ndarray, beats: np.ndarray, function: str, argument = None, chunk: int = 2**20) -> np.ndarray:
+    """Returns `function` of each beat of `audio`, where beat `i` is from `beats[i]` to `beats[i+1]`, and all channels are reduced together.
+    Beats are processed in groups of about `chunk` samples with one segmented reduction per group, so memory doesn't depend on length of the audio."""
+    transform, reduction = FEATURES[function]
+    bounds = np.clip(np.asarray(beats, dtype = np.float64).astype(np.int64), 0, audio.shape[1])
+    n_beats = max(len(bounds) - 1, 0)
+    out = np.zeros(n_beats, dtype = np.float64)
+
+    i = 0
+    while i < n_beats:
+        # last beat of this group, at least one beat
+        j = max(int(np.searchsorted(bounds, bounds[i] + chunk, side = 'right')) - 1, i + 1)
+        j = min(j, n_beats)
+        start, stop = bounds[i], bounds[j]
+        offsets = bounds[i:j] - start
+        lengths = np.diff(bounds[i:j+1])
+
+        if stop > start:
+            values = transform(np.asarray(audio[:, start:stop], dtype = np.float32), argument, bounds[i:j+1] - start)
+            # `reduceat` takes the element at the index for empty segments and fails on index equal to length, they are zeroed below
+            valid = lengths > 0
+            reduced = reduction.reduceat(values, offsets[valid], axis=1)
+            reduced = reduction.reduce(reduced, axis=0)
+            if reduction is np.add: reduced = reduced / (lengths[valid] * audio.shape[0])
+            out[i:j][valid] = reduced
+
+        i = j
+
+    return out
+
+
+class BeatFeatures:
+    """Index of statistics of every beat of `audio`, see `FEATURES`. Each statistic is computed for all beats once,
+    then looking up a beat is O(1). Computed statistics are saved to `cache` keyed by hash of the audio and of the beats."""
+    def __init__(self, audio: "Audio", cache: DiskCache | None = None):
+        self.audio = audio
+        self.cache = cache
+        self._beats = None
+        self._features: dict[tuple[str, typing.Any], np.ndarray] = {}
+
+    def _key(self, function: str, argument):
+        assert self.audio.beats is not None
+        beats_hash = hashlib.sha1(np.ascontiguousarray(self.audio.beats, dtype = np.float64).tobytes()).hexdigest()
+        # version 2: gradients don't cross boundaries of beats
+        return make_key('features', 2, self.audio.hash, beats_hash, function, argument)
+
+    def get(self, function: str, argument = None) -> np.ndarray:
+        """Returns array with `function` of every beat."""
+        if self.audio.beats is None: raise ValueError('This Audio object has no beats')
+        if function not in FEATURES: raise ValueError(f'Invalid function: {function!r}, must be one of {list(FEATURES)}')
+
+        # beats can be reassigned, then all features are computed again
+        if self._beats is not self.audio.beats:
+            self._beats = self.audio.beats
+            self._features.clear()
+
+        if (function, argument) not in self._features:
+            values = None
+            if self.cache is not None:
+                key = self._key(function, argument)
+                cached = self.cache.get(key)
+                if cached is not None: values = cached['values']
+
+            if values is None:
+                values = beat_features(self.audio.audio, self.audio.beats, function, argument)
+                if self.cache is not None: self.cache.set(key, values = values)
+
+            self._features[(function, argument)] = values
+
+        return self._features[(function, argument)]
+
+    def __call__(self, function: str, beat: int, argument = None) -> float:
+        """Returns `function` of beat `beat`, negative beats count from the end."""
+        return float(self.get(function, argument)[int(beat)])
@@ -1,9 +1,91 @@
+import os
+import threading
+
 import numpy as np
 
+from .cache import CACHE_DIR, DiskCache, make_key
+
 def audioread(path) -> tuple[np.ndarray, int]:
     """Returns `(channels, samples)` audio and sr"""
     import pedalboard.io
     with pedalboard.io.AudioFile(path, 'r') as f: # pylint:disable=E1129 # type:ignore
         audio = f.read(f.frames)
         sr = f.samplerate
-    return audio, sr
\ No newline at end of file
+    return audio, sr
+
+
+DECODED_CACHE = DiskCache(os.path.join(CACHE_DIR, 'decoded'), max_bytes = 8 * 2**30, suffix = '.f32')
+"""Decoded audio files as raw interleaved float32, keyed by path, size and modification time of the file."""
+
+def audioread_mmap(path, cache: DiskCache = DECODED_CACHE, chunk: int = 2**20) -> tuple[np.ndarray, int]:
+    """Returns read-only `(channels, samples)` audio and sr. On first use the file is decoded to `cache` in chunks of `chunk` frames,
+    after that the decoded file is memory-mapped, so only the parts of audio that are sliced are read from disk."""
+    import pedalboard.io
+    stat = os.stat(path)
+    key = make_key(os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+
+    with pedalboard.io.AudioFile(path, 'r') as f: # pylint:disable=E1129 # type:ignore
+        sr = f.samplerate
+        channels = f.num_channels
+        file = cache.get_file(key)
+        if file is None:
+            def write(out):
+                # frames are interleaved so that chunks can be appended without knowing total number of frames
+                while True:
+                    audio = f.read(chunk)
+                    if audio.shape[1] == 0: break
+                    out.write(np.ascontiguousarray(audio.T, dtype = np.float32).tobytes())
+            file = cache.write(key, write)
+
+    frames = os.path.getsize(file) // (4 * channels)
+    if frames == 0: return np.zeros((channels, 0), dtype = np.float32), sr
+    return np.memmap(file, dtype = np.float32, mode = 'r', shape = (frames, channels)).T, sr
+
+
+class AudioFileReader:
+    """Array-like `(channels, samples)` view of an audio file, slicing it seeks to needed frames and decodes only them."""
+    def __init__(self, path):
+        import pedalboard.io
+        self.path = path
+        self._file = pedalboard.io.AudioFile(path, 'r') # type:ignore
+        self.sr: int = int(self._file.samplerate)
+        self.shape: tuple[int, int] = (self._file.num_channels, self._file.frames)
+        self.dtype = np.dtype(np.float32)
+        self.ndim = 2
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, s):
+        if not isinstance(s, tuple): s = (s, slice(None))
+        channels, frames = s
+        if not isinstance(frames, slice): raise NotImplementedError(f'{type(self).__name__} only supports slicing frames with a slice')
+
+        start, stop, step = frames.indices(self.shape[1])
+        with self._lock:
+            self._file.seek(start)
+            audio = self._file.read(max(stop - start, 0))
+
+        if step != 1: audio = audio[:, ::step]
+        return audio[channels]
+
+    def __array__(self, dtype = None, copy = None):
+        audio = self[:, :]
+        if dtype is not None: audio = audio.astype(dtype, copy = False)
+        return audio
+
+    def __getstate__(self):
+        return {'path': self.path}
+
+    def __setstate__(self, state):
+        self.__init__(state['path'])
+
+    def close(self):
+        self._file.close()
+
+
+def audiowriter(path, sr: int, channels: int):
+    """Opens an audio file for writing, format is determined by extension. Write `(channels, samples)` arrays to it with `write`."""
+    import pedalboard.io
+    return pedalboard.io.AudioFile(path, 'w', samplerate = sr, num_channels = channels) # type:ignore
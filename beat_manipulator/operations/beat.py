@@ -1,175 +1,162 @@
 import typing
-from collections import OrderedDict, abc
 
 import numpy as np
 
 from ..audio import Audio
-from ..utils import get_next_key, interpolate, op_with_overflow, op_on_longest, op_on_shortest
-from .common import post_step
-from ..effects.effect import apply_effect
+from ..plan import LengthMode, Mode, SourceMode
+from ..timeline import Segment, overlay_overflow, split_spans
+from ..utils import interpolate
+from .common import get_source, post_step
+from ..effects.effect import apply_effects, effects_key
 if typing.TYPE_CHECKING:
     from ..beatswap_ import Beatswap
+    from ..plan import Step
 
 
 
-def _apply_operation_to_beats(beats: list[np.ndarray], index: float, source: np.ndarray, operation, length_mode: str):
-    """Applies an operation to existing beats. Returns modified beats and overflow."""
+def _apply_operation_to_beats(beats: list[Segment], index: float, source: Segment, operation, length_mode: LengthMode, n_written: int = 0):
+    """Puts `source` onto existing beats at `index` using `operation`. Returns `(start, stop)` of the part of source that overflowed past the last beat, or None.
+    `n_written` is the number of beats that were already written to a file and removed from `beats`."""
 
     if index < 0: index = len(beats) + index
-    if index < 0: return beats, None
-    if index > len(beats): return beats, None
+    else: index -= n_written
+    if index < 0: return None
+    if index >= len(beats): return None
 
     cur_beat_index = int(index)
     cur_beat = beats[cur_beat_index]
-    cur_beat_sample = interpolate([0, cur_beat.shape[1]], index % 1)
+    cur_beat_sample = int(interpolate([0, cur_beat.length], index % 1))
 
-    if length_mode == 'overflow':
-        while True:
-            # put audio onto current beat starting from current sample
-            cur_beat[:, cur_beat_sample:], source = op_with_overflow(operation, cur_beat[:, cur_beat_sample:], source) # type:ignore
-            beats[cur_beat_index] = cur_beat
-            #cur_beat[:, cur_beat_sample:cur_beat_sample+arr.shape[1]-cur_src_sample] = operation(cur_beat[:, cur_beat_sample:cur_beat_sample+arr.shape[1]-cur_src_sample], arr[:, cur_src_sample:])
+    if length_mode == LengthMode.OVERFLOW:
+        return overlay_overflow(beats, cur_beat_index, cur_beat_sample, operation, source, 0, source.length)
 
-            # move cursor one source forward
-            if source is None: return beats, None
-            cur_beat_sample += source.shape[1]
+    # median beat length of the track that the beat is from
+    median = None
+    if length_mode in (LengthMode.MEDIAN, LengthMode.MEDIAN_NO_PAD):
+        median = cur_beat.source.median_beat_length() if cur_beat.source.beats is not None else cur_beat.length
 
-            # sample overflows over this beat, move to next beat
-            if cur_beat_sample >= cur_beat.shape[1]:
-                cur_beat_sample = 0
-                cur_beat_index += 1
-                if cur_beat_index >= len(beats): return beats, source
-                cur_beat = beats[cur_beat_index]
+    cur_beat.overlay(cur_beat_sample, operation, source, 0, source.length, length_mode, median = median)
+    return None
 
-    elif length_mode == 'shortest':
-        remainder = op_on_shortest(operation, cur_beat[:, cur_beat_sample:], source)
-        beats[cur_beat_index] = np.concatenate([cur_beat[:, :cur_beat_sample], remainder], axis=1)
-        return beats, None
 
-    elif length_mode == 'longest':
-        remainder = op_on_longest(operation, cur_beat[:, cur_beat_sample:], source)
-        beats[cur_beat_index] = np.concatenate([cur_beat[:, :cur_beat_sample], remainder], axis=1)
-        return beats, None
+def _apply_overflow(beat: Segment, operation, overflow: list[tuple[Segment, int, int]]):
+    """Puts overflow from previous beats onto the start of `beat`, returns what still overflows past it."""
+    remaining = []
+    for segment, start, stop in overflow:
+        start += beat.overlay(0, operation, segment, start, stop, 'overflow')
+        if start < stop: remaining.append((segment, start, stop))
+    return remaining
 
-    elif length_mode == 'existing':
-        remainder, _ = op_with_overflow(operation, cur_beat[:, cur_beat_sample:], source)
-        beats[cur_beat_index] = np.concatenate([cur_beat[:, :cur_beat_sample], remainder], axis=1)
-        return beats, None
 
-    elif length_mode == 'new':
-        remainder, _ = op_with_overflow(operation, source, cur_beat[:, cur_beat_sample:], )
-        beats[cur_beat_index] = np.concatenate([cur_beat[:, :cur_beat_sample], remainder], axis=1)
-        return beats, None
+def _beat_range(step: "Step"):
+    """Returns start and stop of a beat in beats."""
+    if step.start is None: raise ValueError(f"{step.op} doesn't have `start` key")
+    if step.stop is None: return step.start, step.start + (step.length if step.length is not None else 1)
+    return step.start, step.stop
 
-    else: raise ValueError(f'Invalid {length_mode = }')
 
+def _resolve_bounds(beatswap: "Beatswap"):
+    """Computes start and stop in samples of all steps that slice by beats with a single interpolation per source."""
+    by_source: dict[typing.Any, list["Step"]] = {}
+    for step in beatswap.plan.steps:
+        if step.bounds is not None or step.source_mode != SourceMode.BEATS or step.start is None: continue
+        source = beatswap._sources.get(step.source, None)
+        if isinstance(source, Audio) and source.beats is not None and beatswap.sr is not None: by_source.setdefault(step.source, []).append(step)
 
+    for name, steps in by_source.items():
+        ranges = np.array([_beat_range(step) for step in steps], dtype = np.float64)
 
-def operation_beat(beatswap: "Beatswap", pattern: OrderedDict[typing.Any, dict[str, typing.Any]], key):
-    """Adds a beat."""
-    op = pattern[key]
+        # negative positions raise an error when that step is executed
+        valid = (ranges >= 0).all(1)
+        steps = [step for step, v in zip(steps, valid) if v]
+        samples = beatswap._sources[name].resampled(beatswap.sr).beats_to_samples(ranges[valid].ravel()).reshape(-1, 2).tolist()
+        for step, (start, stop) in zip(steps, samples): step.bounds = (start, stop)
 
-    # get the source audio and make sure it is Audio
-    source_name = op.get('source', '__main_audio__')
-    if source_name in beatswap._sources:
-        source = beatswap._sources[source_name]
-    else:
-        source = source_name
-    if not isinstance(source, Audio):
-        source = beatswap._sources[source_name] = Audio(source)
 
-    # source mode (beat / seconds / samples)
-    source_mode = op.get('source mode', 'beats')
+def operation_beat(beatswap: "Beatswap", step: "Step"):
+    """Adds a beat."""
+
+    # get the source audio at output sample rate and make sure it is Audio, beats are detected if slicing by beats
+    source = get_source(beatswap, step.source, detect = step.source_mode == SourceMode.BEATS)
 
     # slice source to make the new beat
-    if source_mode == 'beats':
-
-        # make sure beats are detected
-        if source.beats is None: source.detect_beats()
+    if step.source_mode == SourceMode.BEATS:
 
         # get start and end
-        if 'start' not in op: raise ValueError(f"{op} doesn't have `start` key")
-        start = op['start']
-        if 'stop' not in op: stop = start + op.get('length', 1)
-        else: stop = op['stop']
-
-        # slice
+        start, stop = _beat_range(step)
         if start >= len(source)-1 or stop >= len(source)-1: return False
-        beat = source[start:stop]
+
+        # slice, positions of all steps are resolved at once and then reused until they are incremented
+        if step.bounds is None: _resolve_bounds(beatswap)
+        if step.bounds is None: step.bounds = (source.beat_to_sample(start), source.beat_to_sample(stop))
+        beat = Segment(source, *step.bounds)
 
     # slice the audio
-    elif source_mode in ('seconds', 'samples'):
-        start = op.get('start', 0)
-        stop = op.get('stop', None)
-        if stop is None:
-            length = op.get('length', None)
-            if length is not None: stop = start + length
-        if source_mode == 'seconds':
+    else:
+        start = step.start if step.start is not None else 0
+        stop = step.stop
+        if stop is None and step.length is not None: stop = start + step.length
+        if step.source_mode == SourceMode.SECONDS:
             start = int(start * source.sr)
             if stop is not None: stop = int(stop * source.sr)
 
-        beat = source.audio[start:stop].copy()
-
-    else:
-        raise ValueError(f"Source mode is not valid: {source_mode}")
+        start, stop, _ = slice(start, stop).indices(source.audio.shape[1])
+        beat = Segment(source, start, max(start, stop))
 
-    if 'effects' in op:
-        for eff in op['effects']:
-            func = eff['function']
-            args = eff.get('args', ())
-            kwargs = eff.get('kwargs', {})
-            beat = apply_effect(beat, source.sr, effect = func, args = args, kwargs=kwargs)
+    if len(step.effects) > 0:
+        beat.effects = step.effects
+        key = effects_key(source.hash, beat.start, beat.stop, beatswap.sr, step.effects) if step.cache_effects else None
+        beat.data = apply_effects(beat.read(), beatswap.sr, step.effects, key = key) # type:ignore
+        beat.length = beat.audio_length
 
     # add overflow if appending
-    mode = op.get('mode', 'append')
-    if mode == 'append':
-        if beatswap._overflow is not None:
-            beat, beatswap._overflow = op_with_overflow(np.add, beat, beatswap._overflow)
-        if beatswap._mul_overflow is not None:
-            beat, beatswap._mul_overflow = op_with_overflow(np.multiply, beat, beatswap._mul_overflow)
+    mode = beat.mode = step.mode
+    if mode == Mode.APPEND:
+        beatswap._overflow = _apply_overflow(beat, np.add, beatswap._overflow)
+        beatswap._mul_overflow = _apply_overflow(beat, np.multiply, beatswap._mul_overflow)
 
     # add the beat
-    mode = op.get('mode', 'append')
-
-    if mode == 'append':
+    if mode == Mode.APPEND:
         beatswap.beats.append(beat)
 
-    elif mode == 'prepend':
+    elif mode == Mode.PREPEND:
         beatswap.beats.insert(0, beat)
 
-    elif mode == 'insert':
-        if 'index' not in op: raise ValueError(f"{op} with mode = 'insert' doesn't have `index` key")
-        beatswap.beats.insert(op['index'], beat)
+    elif mode == Mode.INSERT:
+        index = int(step.index) # type:ignore
+        index = index - beatswap._n_written if index >= 0 else index
+        # position where `list.insert` puts the beat
+        index = min(max(index if index >= 0 else len(beatswap.beats) + index, 0), len(beatswap.beats))
+        split_spans(beatswap.beats, index)
+        beatswap.beats.insert(index, beat)
 
-    elif mode == 'add':
-        beatswap.beats, overflow = _apply_operation_to_beats(
+    elif mode == Mode.ADD:
+        overflow = _apply_operation_to_beats(
             beats = beatswap.beats,
-            index = op.get('index', -1),
+            index = step.index if step.index is not None else -1,
             source = beat,
             operation = np.add,
-            length_mode = op.get('length mode', 'overflow')
+            length_mode = step.length_mode,
+            n_written = beatswap._n_written,
         )
-        if beatswap._overflow is None: beatswap._overflow = overflow
-        elif overflow is not None: beatswap._overflow = op_on_longest(np.add, beatswap._overflow, overflow)
+        if overflow is not None: beatswap._overflow.append((beat, *overflow))
 
-    elif mode == 'multiply':
-        if 'index' not in op: raise ValueError(f"{op} with mode = 'multiply' doesn't have `index` key")
-        beatswap.beats, mul_overflow = _apply_operation_to_beats(
+    elif mode == Mode.MULTIPLY:
+        mul_overflow = _apply_operation_to_beats(
             beats = beatswap.beats,
-            index = op.get('index', -1),
+            index = step.index, # type:ignore
             source = beat,
             operation = np.multiply,
-            length_mode = op.get('length mode', 'overflow')
+            length_mode = step.length_mode,
+            n_written = beatswap._n_written,
         )
-        if beatswap._mul_overflow is None: beatswap._mul_overflow = mul_overflow
-        elif mul_overflow is not None: beatswap._mul_overflow = op_on_longest(np.multiply, beatswap._mul_overflow, mul_overflow)
-    else:
-        raise ValueError(f"Invalid mode: {mode}")
+        if mul_overflow is not None: beatswap._mul_overflow.append((beat, *mul_overflow))
 
     # increment start/stop/step
-    increment = op.get('increment', 0)
-    if 'start' in op: op['start'] =  op['start'] + increment
-    if 'stop' in op: op['stop'] = op['stop'] + increment
-    if 'length' in op: op['length'] = op['length'] + increment
+    increment = step.increment
+    if step.start is not None: step.start = step.start + increment
+    if step.stop is not None: step.stop = step.stop + increment
+    if step.length is not None: step.length = step.length + increment
+    if increment != 0: step.bounds = None
 
-    return post_step(beatswap, pattern, key)
\ No newline at end of file
+    return post_step(beatswap, step)
@@ -1,64 +1,25 @@
-import random
 import typing
-from collections import OrderedDict, abc
-
-import numpy as np
 
 from ..audio import Audio
-from ..utils import get_next_key, interpolate
-
 if typing.TYPE_CHECKING:
     from ..beatswap_ import Beatswap
+    from ..plan import Step
 
 
-def _shuffle(beatswap: "Beatswap", ops, shuffle_key: str):
-    shuffle_groups:dict[typing.Any, list] = {}
-
-    # find all shuffle groups
-    for i, key, op in ops:
-        if shuffle_key in op:
-            groups = op[shuffle_key]
-            if not isinstance(groups, (list,tuple)): groups = [groups]
-
-            for group in groups:
-                if group not in shuffle_groups: shuffle_groups[group] = [i]
-                shuffle_groups[group].append(i)
-
-    if len(shuffle_groups) > 0:
-        # shuffle all shuffle groups
-        shuffled_shuffle_groups = {k: v.copy() for k, v in shuffle_groups.items()}
-        for group in shuffled_shuffle_groups.values():
-            random.shuffle(group)
-
-        # assign shuffled groups to ops
-        shuffled_ops = ops.copy()
-        for group, indexes in shuffle_groups.items():
-            shuffled_indexes = shuffled_shuffle_groups[group]
-            for old_index, new_index in zip(indexes, shuffled_indexes):
-                shuffled_ops[old_index] = ops[new_index]
-
-        ops = shuffled_ops
-        pattern = beatswap.pattern = OrderedDict({k:v for i,k,v in ops})
-
-    else: pattern = beatswap.pattern
-    return ops, pattern
-
-def post_step(beatswap: "Beatswap", pattern: OrderedDict[typing.Any, dict[str, typing.Any]], key):
-    op = pattern[key]
-    ops = [(i, key, op) for i,(key,op) in enumerate(pattern.items())]
-
-    # shuffle on first operation
-    if beatswap._current_key == list(beatswap.pattern.keys())[0]:
-        ops, pattern = _shuffle(beatswap, ops, 'shuffle group')
-
-    # shuffle always
-    ops, pattern = _shuffle(beatswap, ops, 'shuffle always group')
+def get_source(beatswap: "Beatswap", name, detect = False) -> Audio:
+    """Returns source `name` as `Audio` at output sample rate, loading it from path if it is not in sources.
+    If `detect` is True, beats are detected if the source has none."""
+    source = beatswap._sources.get(name, name)
+    if not isinstance(source, Audio):
+        source = beatswap._sources[name] = Audio(source, lazy = beatswap.lazy)
 
-    # shuffle trigger
-    # ...
+    if beatswap.sr is None: beatswap.sr = source.sr
+    # beats are detected at the original sample rate so that they are loaded from the beat cache, `resampled` rescales them
+    if detect and source.beats is None: source.detect_beats()
+    return source.resampled(beatswap.sr)
 
-    # advance to next operation
-    if 'next' in op: beatswap._current_key = op['next']
-    else: beatswap._current_key = get_next_key(beatswap.pattern, beatswap._current_key)
 
-    return True
\ No newline at end of file
+def post_step(beatswap: "Beatswap", step: "Step"):
+    """Moves to the next operation, performing shuffles."""
+    beatswap.plan.advance(beatswap.rng)
+    return True
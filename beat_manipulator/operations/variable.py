@@ -0,0 +1,40 @@
+import random
+import typing
+
+from ..features import FEATURES
+from .common import get_source, post_step
+if typing.TYPE_CHECKING:
+    from ..beatswap_ import Beatswap
+    from ..plan import Step
+
+
+def _random(rng: random.Random, argument, integer: bool):
+    start, stop, *step = argument
+    if len(step) > 0:
+        n = int((stop - start) // step[0])
+        return start + rng.randint(0, n) * step[0]
+    if integer: return rng.randint(start, stop)
+    return rng.uniform(start, stop)
+
+
+def operation_create_variable(beatswap: "Beatswap", step: "Step"):
+    """Creates a variable from `value`, or from `function` of beat `beat` of the source. Statistics of beats are looked up in `Audio.features`."""
+    op = step.op
+    if 'name' not in op: raise ValueError(f"{op} doesn't have `name` key")
+
+    function = op.get('function', None)
+    if function is None:
+        if 'value' not in op: raise ValueError(f"{op} doesn't have `value` or `function` key")
+        value = op['value']
+
+    elif function in ('random', 'randint'):
+        value = _random(beatswap.rng, op['argument'], integer = function == 'randint')
+
+    elif function in FEATURES:
+        source = get_source(beatswap, step.source, detect = True)
+        value = source.features(function, op.get('beat', -1), op.get('argument', None))
+
+    else: raise ValueError(f"Invalid function: {function!r} in {op}")
+
+    beatswap._variables[op['name']] = value
+    return post_step(beatswap, step)
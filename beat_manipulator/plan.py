@@ -0,0 +1,147 @@
+"""Patterns are compiled into a plan once, so that each step doesn't need to look anything up in the pattern dictionary."""
+import enum
+import math
+import typing
+from collections import abc
+
+
+class SourceMode(str, enum.Enum):
+    BEATS = 'beats'
+    SECONDS = 'seconds'
+    SAMPLES = 'samples'
+
+class Mode(str, enum.Enum):
+    APPEND = 'append'
+    PREPEND = 'prepend'
+    INSERT = 'insert'
+    ADD = 'add'
+    MULTIPLY = 'multiply'
+
+class LengthMode(str, enum.Enum):
+    OVERFLOW = 'overflow'
+    SHORTEST = 'shortest'
+    LONGEST = 'longest'
+    EXISTING = 'existing'
+    NEW = 'new'
+    MEDIAN = 'median'
+    MEDIAN_NO_PAD = 'median no pad'
+
+
+def _enum(cls: type[enum.Enum], op: dict, key: str, default):
+    value = op.get(key, default)
+    try: return cls(value)
+    except ValueError: raise ValueError(f"Invalid {key}: {value!r} in {op}") from None
+
+
+def _groups(op: dict, key: str) -> list:
+    if key not in op: return []
+    groups = op[key]
+    if not isinstance(groups, (list, tuple)): groups = [groups]
+    return list(groups)
+
+
+class Step:
+    """A compiled operation. `start`, `stop` and `length` change during the run when there is `increment`,
+    the pattern dictionary itself is not modified."""
+    __slots__ = (
+        'key', 'op', 'operation', 'source', 'source_mode', 'mode', 'length_mode', 'index',
+        'start', 'stop', 'length', 'increment', 'effects', 'cache_effects', 'next', 'bounds'
+    )
+    def __init__(self, key, op: dict[str, typing.Any], operations: dict[str, abc.Callable]):
+        self.key = key
+        self.op = op
+
+        operation_type = op.get('operation', 'beat')
+        if operation_type not in operations: raise ValueError(f"Invalid operation: {operation_type!r} in {op}")
+        self.operation = operations[operation_type]
+
+        self.source = op.get('source', '__main_audio__')
+        self.source_mode = _enum(SourceMode, op, 'source mode', 'beats')
+        self.mode = _enum(Mode, op, 'mode', 'append')
+        self.length_mode = _enum(LengthMode, op, 'length mode', 'overflow')
+
+        self.index: float | None = op.get('index', None)
+        if self.index is None and self.mode in (Mode.INSERT, Mode.MULTIPLY):
+            raise ValueError(f"{op} with mode = '{self.mode.value}' doesn't have `index` key")
+
+        self.start = op.get('start', None)
+        self.stop = op.get('stop', None)
+        self.length = op.get('length', None)
+        self.increment = op.get('increment', 0)
+
+        self.effects: list[tuple[str, typing.Any, typing.Any]] = [
+            (eff['function'], eff.get('args', ()), eff.get('kwargs', {})) for eff in op.get('effects', ())
+        ]
+        # any effect can set `cache: false` if it shouldn't be cached
+        self.cache_effects = all(eff.get('cache', True) for eff in op.get('effects', ()))
+
+        # index of the next step, set by `Plan`
+        self.next: int | None = None
+
+        # start and stop in samples, resolved for all steps at once and reset when start or stop change
+        self.bounds: tuple[int, int] | None = None
+
+
+class Plan:
+    """Pattern compiled into a list of steps. Steps are executed in `self.order`, which shuffle groups permute."""
+    def __init__(self, pattern: dict[typing.Any, dict[str, typing.Any]], operations: dict[str, abc.Callable]):
+        if len(pattern) == 0: raise ValueError('Pattern is empty')
+
+        self.steps = [Step(key, op, operations) for key, op in pattern.items()]
+        index_of = {step.key: i for i, step in enumerate(self.steps)}
+        for step in self.steps:
+            if 'next' in step.op:
+                if step.op['next'] not in index_of: raise ValueError(f"{step.op} has `next` key which isn't in the pattern")
+                step.next = index_of[step.op['next']]
+
+        # position -> step, and step -> position
+        self.order = list(range(len(self.steps)))
+        self.position = list(range(len(self.steps)))
+
+        # group -> steps in that group
+        self.shuffle_groups: dict[typing.Any, list[int]] = {}
+        self.shuffle_always_groups: dict[typing.Any, list[int]] = {}
+        for i, step in enumerate(self.steps):
+            for group in _groups(step.op, 'shuffle group'): self.shuffle_groups.setdefault(group, []).append(i)
+            for group in _groups(step.op, 'shuffle always group'): self.shuffle_always_groups.setdefault(group, []).append(i)
+
+        self.current = 0
+        """index of the step that will be executed next"""
+
+    def shuffle(self, groups: dict[typing.Any, list[int]], rng):
+        """Shuffles positions of steps within each group."""
+        for steps in groups.values():
+            positions = sorted(self.position[i] for i in steps)
+            steps = [self.order[p] for p in positions]
+            rng.shuffle(steps)
+            for p, i in zip(positions, steps):
+                self.order[p] = i
+                self.position[i] = p
+
+    def advance(self, rng):
+        """Moves to the next step after executing `self.current`, performing shuffles."""
+        step = self.steps[self.current]
+
+        # shuffle on first operation
+        if self.position[self.current] == 0 and len(self.shuffle_groups) > 0:
+            self.shuffle(self.shuffle_groups, rng)
+
+        # shuffle always
+        if len(self.shuffle_always_groups) > 0:
+            self.shuffle(self.shuffle_always_groups, rng)
+
+        if step.next is not None: self.current = step.next
+        else: self.current = self.order[(self.position[self.current] + 1) % len(self.order)]
+
+    def mutable_beats(self) -> tuple[int, float]:
+        """Returns `(last, first)` - steps can change last `last` beats and all beats starting from index `first`,
+        other beats are final and can be written."""
+        last = 0
+        first = math.inf
+        for step in self.steps:
+            if step.mode == Mode.PREPEND: first = 0
+            elif step.mode in (Mode.INSERT, Mode.ADD, Mode.MULTIPLY):
+                index = step.index if step.index is not None else -1
+                if index < 0: last = max(last, math.ceil(-index))
+                else: first = min(first, int(index))
+        return last, first
@@ -1,10 +1,32 @@
-import itertools
-
 import numpy as np
 
+
+def _grid(point: int, step: float, length: int) -> np.ndarray:
+    """Same as `np.arange(point, 0, -step)[::-1][:-1]` followed by `np.arange(point, length, step)`,
+    points of a grid with `step` through `point` that are in `(0, length)`."""
+    n_backward = max(int(np.ceil(point / step)), 1) - 1
+    n_forward = max(int(np.ceil((length - point) / step)), 0)
+    return point + np.arange(-n_backward, n_forward) * step
+
+
+def _closest_errors(grids: np.ndarray, valid: np.ndarray, downbeats: np.ndarray) -> np.ndarray:
+    """For each row of `grids`, returns sum of distances from valid points to their closest downbeats. `downbeats` must be sorted."""
+    # closest downbeat is either the one before or the one after the insertion point
+    right = np.searchsorted(downbeats, grids).clip(1, len(downbeats) - 1)
+    dist = np.minimum(np.abs(grids - downbeats[right - 1]), np.abs(grids - downbeats[right]))
+    return np.where(valid, dist, 0).sum(1)
+
+
+def _beats_between(downbeats: np.ndarray, n: int = 4) -> np.ndarray:
+    """Puts `n` evenly spaced beats between each pair of consecutive downbeats, starting from the first downbeat of the pair."""
+    beat_lengths = np.diff(downbeats) / n
+    return (downbeats[:-1, None] + beat_lengths[:, None] * np.arange(n)).ravel()
+
+
 def downbeat_consistency_fixedBPM(audio, downbeats):
     """Uses median downbeat length and finds the best downbeat to project median downbeats from.
     Puts 4 beats between each downbeat."""
+    downbeats = np.asarray(downbeats)
 
     # step 1 - find the median downbeat length
     # not ideal because this biases smaller downbeats as there are more of them
@@ -15,44 +37,30 @@ def downbeat_consistency_fixedBPM(audio, downbeats):
     #print(f'{median_length = }')
 
     # step 2 - find the best middle point
-    middlepoint_errors = []
-    for d1,d2 in itertools.pairwise(downbeats):
-        # project downbeats of median length from current downbeat
-        projected_forward = np.arange(int(d1), audio.shape[1], median_length)
-        projected_backward = np.arange(int(d1), 0, -median_length)
-        projected = np.concatenate([projected_backward[::-1][:-1], projected_forward])
+    # project downbeats of median length from every downbeat except the last one, all grids are in one array,
+    # row `i` has offsets `k` from `-max_backward` and the points outside of the audio are masked out
+    length = audio.shape[1]
+    points = downbeats[:-1].astype(int)
+    max_backward = int(np.ceil(points.max() / median_length)) if len(points) > 0 else 0
+    offsets = np.arange(-max_backward, int(np.ceil(length / median_length)) + 1)
+    grids = points[:, None] + offsets * median_length
+    valid = np.where(offsets < 0, grids > 0, grids < length)
 
-        # find the closest downbeat to each projected point
-        diff_mat = np.abs(projected[:,None] - downbeats)
-        closest = downbeats[np.argmin(diff_mat, axis = 1).astype(int)]
-
-        # error between projected downbeats and their closest real downbeats
-        middlepoint_errors.append(np.abs(projected - closest).sum())
+    # error between projected downbeats and their closest real downbeats
+    middlepoint_errors = _closest_errors(grids, valid, np.sort(downbeats))
 
     # lowest error downbeat wins
     best_point = downbeats[np.argmin(middlepoint_errors)]
     #print(f'{best_point = }')
 
     # project median length downbeats from best point
-    projected_forward = np.arange(int(best_point), audio.shape[1], median_length)
-    projected_backward = np.arange(int(best_point), 0, -median_length)
-    proj_downbeats = np.concatenate([projected_backward[::-1][:-1], projected_forward])
+    proj_downbeats = _grid(int(best_point), median_length, length)
 
     # now we put 4 beats between every projected downbeat
-    proj_beats = []
-    for d1,d2 in itertools.pairwise(proj_downbeats):
-        downbeat_length = d2 - d1
-        beat_length = downbeat_length / 4
-        proj_beats.extend([d1, d1 + beat_length, d1 + beat_length * 2, d1 + beat_length * 3])
+    proj_beats = _beats_between(proj_downbeats)
 
     return proj_beats, proj_downbeats
 
 def beats_from_downbeats(audio, sr, downbeats):
     """puts 4 beats for every downbeat"""
-    beats = []
-    for d1,d2 in itertools.pairwise(downbeats):
-        downbeat_length = d2 - d1
-        beat_length = downbeat_length / 4
-        beats.extend([d1, d1 + beat_length, d1 + beat_length * 2, d1 + beat_length * 3])
-
-    return beats, downbeats
\ No newline at end of file
+    return _beats_between(np.asarray(downbeats)), downbeats
\ No newline at end of file
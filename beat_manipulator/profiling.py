@@ -0,0 +1,99 @@
+"""Opt-in profiling of renders. Pass a `Profiler` to `Beatswap`, then use `Profiler.report` or `Profiler.save_trace`.
+When no profiler is active, instrumented code only checks `active()`."""
+import contextlib
+import json
+import os
+import threading
+import time
+import tracemalloc
+import typing
+from collections import abc
+
+
+class Profiler:
+    """Records wall time, number of calls and bytes allocated by each pattern key, operation type, length mode, effect,
+    beat detection and rendering. Times of sections include times of sections inside them, e.g. time of a key includes its effects.
+
+    Bytes are only recorded if `memory` is True, which uses `tracemalloc` and makes everything much slower.
+    They are the net change in traced memory, so arrays that are freed inside a section aren't counted."""
+    def __init__(self, memory = False):
+        self.memory = memory
+        self.stats: dict[str, dict[typing.Any, dict[str, float]]] = {}
+        self.events: list[dict[str, typing.Any]] = []
+        self._t0 = time.perf_counter()
+        self._lock = threading.Lock()
+
+    def _begin(self):
+        if self.memory and not tracemalloc.is_tracing(): tracemalloc.start()
+        nbytes = tracemalloc.get_traced_memory()[0] if self.memory else 0
+        return time.perf_counter(), nbytes
+
+    def _end(self, begin: tuple[float, int], name, category: str, other: abc.Sequence[tuple[str, typing.Any]] = ()):
+        """Records a section that started at `begin` under `(category, name)` and all `(category, name)` in `other`."""
+        start, start_bytes = begin
+        end = time.perf_counter()
+        nbytes = tracemalloc.get_traced_memory()[0] - start_bytes if self.memory else 0
+
+        with self._lock:
+            for cat, n in ((category, name), *other):
+                stats = self.stats.setdefault(cat, {}).setdefault(n, {'time': 0., 'calls': 0, 'bytes': 0})
+                stats['time'] += end - start
+                stats['calls'] += 1
+                stats['bytes'] += nbytes
+
+            self.events.append({
+                'name': str(name), 'cat': category, 'ph': 'X',
+                'ts': (start - self._t0) * 1e6, 'dur': (end - start) * 1e6,
+                'pid': os.getpid(), 'tid': threading.get_ident(),
+                'args': {cat: str(n) for cat, n in other} | ({'bytes': nbytes} if self.memory else {}),
+            })
+
+    @contextlib.contextmanager
+    def section(self, category: str, name, other: abc.Sequence[tuple[str, typing.Any]] = ()):
+        """Records time spent inside the `with` block under `(category, name)` and also under all `(category, name)` in `other`."""
+        begin = self._begin()
+        try: yield
+        finally: self._end(begin, name, category, other)
+
+    def report(self, sort = True) -> dict[str, dict[typing.Any, dict[str, float]]]:
+        """Returns `{category: {name: {"time": seconds, "calls": n, "bytes": n}}}`, if `sort` is True, names are sorted by time."""
+        with self._lock:
+            if not sort: return {cat: {n: dict(s) for n, s in stats.items()} for cat, stats in self.stats.items()}
+            return {
+                cat: {n: dict(s) for n, s in sorted(stats.items(), key = lambda x: x[1]['time'], reverse = True)}
+                for cat, stats in self.stats.items()
+            }
+
+    def save_trace(self, path: str):
+        """Saves events in Chrome trace format, which can be opened with `chrome://tracing` or https://ui.perfetto.dev."""
+        with self._lock: events = list(self.events)
+        with open(path, 'w', encoding = 'utf8') as f: json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+
+    def clear(self):
+        with self._lock:
+            self.stats.clear()
+            self.events.clear()
+
+
+_state = threading.local()
+
+def active() -> Profiler | None:
+    """Returns profiler that is active in this thread, or None."""
+    return getattr(_state, 'profiler', None)
+
+@contextlib.contextmanager
+def activate(profiler: Profiler | None):
+    """Makes `profiler` active in this thread inside the `with` block, so that effects and beat detection are recorded to it."""
+    previous = active()
+    _state.profiler = profiler
+    try: yield profiler
+    finally: _state.profiler = previous
+
+@contextlib.contextmanager
+def section(category: str, name):
+    """`Profiler.section` of the active profiler, does nothing if there is none."""
+    profiler = active()
+    if profiler is None:
+        yield
+        return
+    with profiler.section(category, name): yield
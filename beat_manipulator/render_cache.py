@@ -0,0 +1,74 @@
+"""Cache of finished renders, keyed by hashes of sources, the pattern and the seed. Renders without a seed aren't cached
+because shuffles and random variables make them different every time."""
+import hashlib
+import os
+import typing
+
+import numpy as np
+
+from .cache import CACHE_DIR, DiskCache, canonical, make_key
+from .effects.effect import NONDETERMINISTIC
+if typing.TYPE_CHECKING:
+    from .audio import Audio
+
+RENDER_CACHE = DiskCache(os.path.join(CACHE_DIR, 'renders'), max_bytes = 4 * 2**30)
+"""Rendered arrays and files."""
+
+MAX_ENTRY_BYTES = 256 * 2**20
+"""Renders larger than this aren't cached."""
+
+STATS = {'hits': 0, 'misses': 0}
+"""Number of lookups in this process that found a cached render and that didn't."""
+
+def _count(cached):
+    STATS['hits' if cached is not None else 'misses'] += 1
+    return cached
+
+
+DETECTION = {'checkpoint': 'final0', 'dbn': True, 'fixed_bpm': True}
+"""Settings of `Audio.detect_beats` that rendering uses for sources without beats, part of keys of those sources."""
+
+def _beats_key(audio: "Audio"):
+    """Hash of beats and downbeats of `audio`, or detection settings if it has no beats, since they are detected during rendering."""
+    if audio.beats is None: return canonical(DETECTION)
+    h = hashlib.sha1(np.ascontiguousarray(audio.beats, dtype = np.float64).tobytes())
+    if audio.downbeats is not None: h.update(np.ascontiguousarray(audio.downbeats, dtype = np.float64).tobytes())
+    return h.hexdigest()
+
+
+def render_key(sources: dict[typing.Any, "Audio"], pattern: dict, seed, **settings) -> str | None:
+    """Returns key of rendering `pattern` with `sources` and `seed`, `settings` are other arguments that change the output.
+    Returns None if `seed` is None or the pattern uses effects in `NONDETERMINISTIC`."""
+    if seed is None: return None
+    for op in pattern.values():
+        if any(effect['function'] in NONDETERMINISTIC for effect in op.get('effects', ())): return None
+
+    hashes = sorted((str(name), audio.hash, _beats_key(audio)) for name, audio in sources.items())
+    # operations run in pattern order and keys keep their types, so only nested values are canonical
+    ops = tuple((key, canonical(op)) for key, op in pattern.items())
+    return make_key('render', hashes, ops, seed, canonical(settings))
+
+
+def get_array(key: str, cache: DiskCache = RENDER_CACHE) -> np.ndarray | None:
+    cached = _count(cache.get(key))
+    if cached is None: return None
+    return cached['audio']
+
+def set_array(key: str, audio: np.ndarray, cache: DiskCache = RENDER_CACHE, max_entry_bytes: int = MAX_ENTRY_BYTES):
+    if audio.nbytes <= max_entry_bytes: cache.set(key, audio = audio)
+
+
+def get_file(key: str, path: str, cache: DiskCache = RENDER_CACHE) -> str | None:
+    """Writes cached file to `path` and returns `path`, or returns None if it isn't cached."""
+    cached = _count(cache.get(key))
+    if cached is None: return None
+    with open(path, 'wb') as f: f.write(cached['data'].tobytes())
+    return path
+
+def set_file(key: str, path: str, cache: DiskCache = RENDER_CACHE, max_entry_bytes: int = MAX_ENTRY_BYTES):
+    """Stores contents of file at `path` as bytes."""
+    if os.path.getsize(path) > max_entry_bytes: return
+    def write(f):
+        with open(path, 'rb') as src: data = np.frombuffer(src.read(), dtype = np.uint8)
+        np.savez(f, data = data)
+    cache.write(key, write)
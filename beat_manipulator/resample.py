@@ -0,0 +1,66 @@
+"""Windowed sinc resampling of whole arrays."""
+import math
+import os
+
+import numpy as np
+
+from .cache import CACHE_DIR, DiskCache
+
+RESAMPLE_CACHE = DiskCache(os.path.join(CACHE_DIR, 'resampled'), max_bytes = 2**31)
+"""Resampled sources, keyed by hash of the source and the target sample rate."""
+
+
+def _kernel(up: int, down: int, zero_crossings: int, rolloff: float, beta: float):
+    """Returns `(offsets, table)`, where `table[phase]` has weights of input samples at `offsets` from the first input sample
+    at or before an output sample which is `phase / up` input samples after it."""
+    # cutoff relative to input Nyquist frequency, lowered when downsampling to remove aliasing
+    cutoff = rolloff * min(1., up / down)
+    half = math.ceil(zero_crossings / cutoff)
+    offsets = np.arange(-half + 1, half + 1)
+
+    # distance from each output position to each input sample, in input samples
+    t = (np.arange(up)[:, None] / up) - offsets[None, :]
+    window = np.i0(beta * np.sqrt(np.clip(1 - (t / half) ** 2, 0, None))) / np.i0(beta)
+    table = cutoff * np.sinc(cutoff * t) * window
+    # each phase sums to 1 so that constant signals stay constant
+    table /= table.sum(1, keepdims = True)
+    return offsets, table.astype(np.float32)
+
+
+def resample(
+    audio: np.ndarray,
+    sr: int,
+    target_sr: int,
+    zero_crossings: int = 32,
+    rolloff: float = 0.945,
+    beta: float = 8.6,
+    chunk: int = 2**14,
+) -> np.ndarray:
+    """Resamples `(channels, samples)` audio from `sr` to `target_sr` with a Kaiser windowed sinc filter with `zero_crossings`
+    on each side. Output sample `n` is at exactly `n * sr / target_sr` input samples, so positions in samples scale by `target_sr / sr`.
+
+    Output is computed in chunks of `chunk` samples, each chunk is one gather and one weighted sum over all channels."""
+    sr, target_sr = int(sr), int(target_sr)
+    if sr == target_sr: return audio
+    audio = np.asarray(audio, dtype = np.float32)
+
+    g = math.gcd(sr, target_sr)
+    up, down = target_sr // g, sr // g
+    offsets, table = _kernel(up, down, zero_crossings, rolloff, beta)
+
+    length = audio.shape[1]
+    n_out = -(-length * up // down)
+    # zero padding so that gathered indexes of first and last samples are valid
+    pad = len(offsets)
+    padded = np.pad(audio, ((0, 0), (pad, pad)))
+
+    out = np.empty((audio.shape[0], n_out), dtype = np.float32)
+    for start in range(0, n_out, chunk):
+        n = np.arange(start, min(start + chunk, n_out), dtype = np.int64)
+        position = n * down
+        base, phase = position // up, position % up
+        # (channels, chunk, taps) samples times (chunk, taps) weights
+        gathered = padded[:, base[:, None] + offsets[None, :] + pad]
+        out[:, start:start + len(n)] = np.einsum('cnk,nk->cn', gathered, table[phase])
+
+    return out
@@ -0,0 +1,463 @@
+"""Local render server, use `python -m beat_manipulator.server` from command line.
+
+Decoded sources and their beats stay in memory between requests, so rendering many patterns of the same songs
+only decodes and detects each song once. Jobs are put into a queue and rendered on a pool of worker threads.
+
+Requests (HTTP/1.1, JSON bodies):
+- `POST /render` with a job like in `batch`: `song`, `pattern` (dictionary, or a string like `1, 3, 2, 4` which also uses `increment`),
+  and optionally `sr`, `output_sr`, `seed`, `fade` and `output`. With `output` the result is written to that path and the response is
+  `{"output": path}`, otherwise the output is streamed back as it's rendered as interleaved float32 samples with chunked encoding,
+  `X-Sample-Rate` and `X-Channels` headers have the format of the samples.
+- `GET /metrics` returns queue depth, number of jobs, latencies and cache hits and misses.
+- `GET /health` returns `{"status": "ok"}`."""
+import argparse
+import asyncio
+import collections
+import concurrent.futures
+import json
+import os
+import threading
+import time
+import traceback
+import typing
+from collections import abc
+
+import numpy as np
+
+from .audio import Audio
+from .beat_detection import get_detector
+from .beatswap_ import Beatswap, parse_pattern, render_sources
+from .effects.effect import EFFECT_CACHE
+from . import render_cache
+
+_REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 500: 'Internal Server Error', 503: 'Service Unavailable'}
+
+
+class HTTPError(Exception):
+    def __init__(self, status: int, message: str):
+        super().__init__(message)
+        self.status = status
+
+
+def _resolve(future: concurrent.futures.Future, fn: abc.Callable, on_error: abc.Callable):
+    """Sets result of `future` to `fn()`, if it raises, calls `on_error` and sets the exception."""
+    try: future.set_result(fn())
+    except BaseException as e: # pylint:disable=W0718
+        on_error()
+        future.set_exception(e)
+
+
+class SourceCache:
+    """Least recently used `Audio` objects, keyed by path and sample rate, sources that are sliced by beats have detected beats.
+    It can be used from multiple threads, sources are loaded and detected outside of the lock, and only once when many threads need them."""
+    def __init__(self, max_sources: int = 64):
+        self.max_sources = max_sources
+        self.hits = 0
+        self.misses = 0
+        self._entries: collections.OrderedDict[tuple[typing.Any, typing.Any], concurrent.futures.Future] = collections.OrderedDict()
+        self._detecting: dict[tuple[typing.Any, typing.Any], concurrent.futures.Future] = {}
+        self._lock = threading.Lock()
+
+    def put(self, path, audio: Audio, sr = None):
+        """Adds already loaded `audio` under `path`, jobs with that `song` or `source` (and `sr` if it is the song) use it."""
+        future = concurrent.futures.Future()
+        future.set_result(audio)
+        with self._lock:
+            self._entries[(path, sr)] = future
+            self._entries.move_to_end((path, sr))
+            while len(self._entries) > self.max_sources: self._entries.popitem(last = False)
+
+    def _audio(self, key: tuple[typing.Any, typing.Any]) -> Audio:
+        with self._lock:
+            future = self._entries.get(key, None)
+            owner = future is None
+            if owner:
+                self.misses += 1
+                future = self._entries[key] = concurrent.futures.Future()
+                while len(self._entries) > self.max_sources: self._entries.popitem(last = False)
+            else:
+                self.hits += 1
+                self._entries.move_to_end(key)
+
+        if owner:
+            def load():
+                audio = Audio(key[0], key[1])
+                audio.hash # pylint:disable=W0104
+                return audio
+            def remove():
+                # failed loads aren't cached so that the next job tries again
+                with self._lock:
+                    if self._entries.get(key, None) is future: del self._entries[key]
+            _resolve(future, load, remove)
+        return future.result()
+
+    def _detect(self, key: tuple[typing.Any, typing.Any], audio: Audio):
+        if audio.beats is not None: return
+        with self._lock:
+            future = self._detecting.get(key, None)
+            owner = future is None
+            if owner: future = self._detecting[key] = concurrent.futures.Future()
+
+        if owner:
+            _resolve(future, lambda: get_detector().detect_many([audio]), lambda: None)
+            with self._lock: del self._detecting[key]
+        future.result()
+
+    def get(self, pattern: dict, song: str | None, sr = None) -> dict[typing.Any, Audio]:
+        """Returns all sources that `pattern` uses, loading the ones that aren't in memory and detecting beats of ones that are sliced by beats."""
+        names = {op.get('source', '__main_audio__') for op in pattern.values()}
+        if song is not None: names.add('__main_audio__')
+        beat_sources = {op.get('source', '__main_audio__') for op in pattern.values() if op.get('source mode', 'beats') == 'beats'}
+
+        sources = {}
+        for name in names:
+            key = (song, sr) if name == '__main_audio__' else (name, None)
+            sources[name] = self._audio(key)
+            if name in beat_sources: self._detect(key, sources[name])
+        return sources
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class Job:
+    """A queued render. Streamed jobs pass `(sr, block)` through `blocks` which holds at most `max_blocks` blocks,
+    so the render waits for the client. `cancel` stops the render when the client is gone."""
+    def __init__(self, params: dict[str, typing.Any], loop: asyncio.AbstractEventLoop, max_blocks: int = 8):
+        self.params = params
+        self.created = time.perf_counter()
+        self.started: float | None = None
+        self.future: asyncio.Future = loop.create_future()
+        # None marks the end
+        self.blocks: asyncio.Queue[tuple[int, np.ndarray] | None] = asyncio.Queue(max_blocks)
+        self.cancelled = threading.Event()
+
+    def cancel(self):
+        """Stops the render after the current block. Queued blocks are dropped, so a render thread waiting for space doesn't wait forever."""
+        self.cancelled.set()
+        while not self.blocks.empty(): self.blocks.get_nowait()
+
+
+class RenderServer:
+    """Renders jobs on `workers` threads (number of CPUs by default). At most `max_queue` jobs wait in the queue,
+    more requests get status 503. Up to `max_sources` decoded sources are kept in memory.
+
+    Use `start(host, port)` or `start(path = ...)` for a Unix socket, then `serve_forever()`, or `async with` to start
+    and stop it. `metrics()` has the same dictionary as `GET /metrics`."""
+    def __init__(
+        self,
+        workers: int | None = None,
+        max_queue: int = 256,
+        max_sources: int = 64,
+        max_blocks: int = 8,
+        latency_window: int = 1000,
+    ):
+        self.workers = workers if workers is not None else (os.cpu_count() or 1)
+        self.max_blocks = max_blocks
+        self.sources = SourceCache(max_sources)
+        self.queue: asyncio.Queue[Job] | None = None
+        self.max_queue = max_queue
+        self.running = 0
+        self.completed = 0
+        self.failed = 0
+        self.cancelled = 0
+        self._waits: collections.deque[float] = collections.deque(maxlen = latency_window)
+        self._latencies: collections.deque[float] = collections.deque(maxlen = latency_window)
+        self._executor: concurrent.futures.ThreadPoolExecutor | None = None
+        self._tasks: list[asyncio.Task] = []
+        self._server: asyncio.AbstractServer | None = None
+
+    async def start(self, host: str = '127.0.0.1', port: int = 8765, path: str | None = None):
+        """Starts listening on `host:port`, or on Unix socket `path` if it is specified. Use port 0 to pick a free port."""
+        self.queue = asyncio.Queue(self.max_queue)
+        self._executor = concurrent.futures.ThreadPoolExecutor(self.workers, thread_name_prefix = 'render')
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        if path is not None: self._server = await asyncio.start_unix_server(self._handle, path)
+        else: self._server = await asyncio.start_server(self._handle, host, port)
+        return self
+
+    @property
+    def address(self):
+        """Address that the server listens on, `(host, port)` or socket path."""
+        assert self._server is not None
+        return self._server.sockets[0].getsockname()
+
+    async def serve_forever(self):
+        assert self._server is not None
+        await self._server.serve_forever()
+
+    async def close(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+        for task in self._tasks: task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions = True)
+        if self._executor is not None: self._executor.shutdown(wait = True)
+
+    async def __aenter__(self):
+        if self._server is None: await self.start()
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    def metrics(self) -> dict[str, typing.Any]:
+        def stats(values: abc.Sequence[float]):
+            if len(values) == 0: return {'mean': None, 'p50': None, 'p95': None, 'max': None}
+            v = np.asarray(values)
+            return {'mean': float(v.mean()), 'p50': float(np.percentile(v, 50)), 'p95': float(np.percentile(v, 95)), 'max': float(v.max())}
+
+        return {
+            'queue depth': self.queue.qsize() if self.queue is not None else 0,
+            'running': self.running,
+            'completed': self.completed,
+            'failed': self.failed,
+            'cancelled': self.cancelled,
+            'workers': self.workers,
+            'wait seconds': stats(self._waits),
+            'latency seconds': stats(self._latencies),
+            'sources': {'resident': len(self.sources), 'hits': self.sources.hits, 'misses': self.sources.misses},
+            'effects': {'hits': EFFECT_CACHE.hits, 'misses': EFFECT_CACHE.misses, 'bytes': EFFECT_CACHE.nbytes},
+            'renders': dict(render_cache.STATS),
+        }
+
+    def _render(self, job: Job, loop: asyncio.AbstractEventLoop):
+        """Runs in a worker thread. Streamed blocks are passed to the event loop as they are rendered."""
+        params = job.params
+        pattern = params['pattern']
+        if isinstance(pattern, str): pattern = parse_pattern(pattern, params.get('increment', 0))
+        sr = params.get('sr', None)
+        fade = params.get('fade', 0)
+        seed = params.get('seed', None)
+        output_sr = params.get('output_sr', None)
+        # each job gets its own dictionary because Beatswap adds sources to it, Audio objects are shared
+        sources = dict(self.sources.get(pattern, params.get('song', None), sr = sr))
+
+        output = params.get('output', None)
+        if output is not None:
+            os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok = True)
+            return {'output': render_sources(sources, pattern, output = output, fade = fade, seed = seed, output_sr = output_sr)}
+
+        def put(item):
+            # waits while the queue is full, so at most `max_blocks` blocks are rendered ahead of the client
+            asyncio.run_coroutine_threadsafe(job.blocks.put(item), loop).result()
+
+        beatswap = Beatswap(pattern, sources, fade = fade, seed = seed, sr = output_sr)
+        blocks = beatswap.iter_blocks(max_seconds = params.get('max_seconds', None))
+        for block in blocks:
+            if job.cancelled.is_set():
+                blocks.close()
+                return {'cancelled': True}
+            put((beatswap.sr, block))
+        put(None)
+        return {'sr': beatswap.sr, 'channels': beatswap._channels, 'time': beatswap.timings}
+
+    async def _worker(self):
+        assert self.queue is not None and self._executor is not None
+        loop = asyncio.get_running_loop()
+        while True:
+            job = await self.queue.get()
+            job.started = time.perf_counter()
+            self._waits.append(job.started - job.created)
+            self.running += 1
+            try:
+                result = await loop.run_in_executor(self._executor, self._render, job, loop)
+                if result.get('cancelled', False): self.cancelled += 1
+                else: self.completed += 1
+                if not job.future.done(): job.future.set_result(result)
+            except Exception as e: # pylint:disable=W0718
+                self.failed += 1
+                if not job.future.done(): job.future.set_exception(e)
+                # ends the stream if the job failed while streaming
+                if not job.cancelled.is_set(): await job.blocks.put(None)
+            finally:
+                self.running -= 1
+                self._latencies.append(time.perf_counter() - job.created)
+                self.queue.task_done()
+
+    def submit(self, params: dict[str, typing.Any]) -> Job:
+        """Puts a job into the queue without a request, raises `HTTPError` with status 503 if the queue is full."""
+        assert self.queue is not None
+        if 'pattern' not in params: raise HTTPError(400, "Job has no 'pattern'")
+        job = Job(params, asyncio.get_running_loop(), self.max_blocks)
+        try: self.queue.put_nowait(job)
+        except asyncio.QueueFull as e: raise HTTPError(503, 'Render queue is full') from e
+        return job
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                request = await _read_request(reader)
+                if request is None: break
+                method, target, headers, body = request
+                try:
+                    keep_alive = await self._respond(writer, method, target, body)
+                except HTTPError as e:
+                    await _send(writer, e.status, {'error': str(e)})
+                    keep_alive = True
+                except ConnectionError:
+                    raise
+                except Exception: # pylint:disable=W0718
+                    await _send(writer, 500, {'error': traceback.format_exc()})
+                    keep_alive = True
+                if not keep_alive or headers.get('connection', '').lower() == 'close': break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def _respond(self, writer: asyncio.StreamWriter, method: str, target: str, body: bytes) -> bool:
+        """Sends response to a request, returns False if the connection must be closed."""
+        if method == 'GET' and target == '/health': return await _send(writer, 200, {'status': 'ok'})
+        if method == 'GET' and target == '/metrics': return await _send(writer, 200, self.metrics())
+        if method != 'POST' or target != '/render': raise HTTPError(404, f'No route for {method} {target}')
+
+        try: params = json.loads(body)
+        except ValueError as e: raise HTTPError(400, f'Invalid JSON: {e}') from e
+        job = self.submit(params)
+
+        if params.get('output', None) is not None:
+            return await _send(writer, 200, await job.future)
+
+        try:
+            # headers are sent with the first block because the format is known only after the first beats are rendered
+            item = await job.blocks.get()
+            if item is None: return await _send(writer, 200, await job.future)
+
+            sr, block = item
+            writer.write(_head(200, {
+                'Content-Type': 'application/octet-stream', 'Transfer-Encoding': 'chunked',
+                'X-Sample-Rate': str(sr), 'X-Channels': str(block.shape[0]),
+            }))
+            while item is not None:
+                data = np.ascontiguousarray(item[1].T, dtype = np.float32).tobytes()
+                writer.write(f'{len(data):x}\r\n'.encode() + data + b'\r\n')
+                await writer.drain()
+                item = await job.blocks.get()
+        except (ConnectionError, asyncio.CancelledError):
+            # the client is gone, so the rest isn't rendered
+            job.cancel()
+            raise
+
+        # the status was already sent, closing without the last chunk tells the client that the stream is incomplete
+        try: await job.future
+        except Exception: # pylint:disable=W0718
+            return False
+        writer.write(b'0\r\n\r\n')
+        await writer.drain()
+        return True
+
+
+def _head(status: int, headers: dict[str, str]) -> bytes:
+    lines = [f'HTTP/1.1 {status} {_REASONS.get(status, "")}'] + [f'{k}: {v}' for k, v in headers.items()]
+    return ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1')
+
+async def _send(writer: asyncio.StreamWriter, status: int, obj):
+    data = json.dumps(obj).encode('utf8')
+    writer.write(_head(status, {'Content-Type': 'application/json', 'Content-Length': str(len(data))}) + data)
+    await writer.drain()
+    return True
+
+async def _read_request(reader: asyncio.StreamReader):
+    """Returns `(method, target, headers, body)`, or None if the connection was closed."""
+    line = await reader.readline()
+    if not line: return None
+    try: method, target, _ = line.decode('latin-1').split(' ', 2)
+    except ValueError as e: raise ConnectionError(f'Invalid request line: {line!r}') from e
+
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''): break
+        name, _, value = line.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip()
+
+    body = await reader.readexactly(int(headers.get('content-length', 0)))
+    return method, target, headers, body
+
+
+class RenderClient:
+    """Client of `RenderServer` at `host:port`, or at Unix socket `path`. Each request uses a new connection."""
+    def __init__(self, host: str = '127.0.0.1', port: int = 8765, path: str | None = None):
+        self.host = host
+        self.port = port
+        self.path = path
+
+    async def request(self, method: str, target: str, obj = None) -> tuple[int, dict[str, str], bytes]:
+        """Sends a request with `obj` as JSON body, returns `(status, headers, body)`."""
+        if self.path is not None: reader, writer = await asyncio.open_unix_connection(self.path)
+        else: reader, writer = await asyncio.open_connection(self.host, self.port)
+        try:
+            body = json.dumps(obj).encode('utf8') if obj is not None else b''
+            head = f'{method} {target} HTTP/1.1\r\nHost: {self.host}\r\nConnection: close\r\nContent-Length: {len(body)}\r\n\r\n'
+            writer.write(head.encode('latin-1') + body)
+            await writer.drain()
+
+            status = int((await reader.readline()).decode('latin-1').split(' ', 2)[1])
+            headers = {}
+            while True:
+                line = await reader.readline()
+                if line in (b'\r\n', b'\n', b''): break
+                name, _, value = line.decode('latin-1').partition(':')
+                headers[name.strip().lower()] = value.strip()
+
+            if headers.get('transfer-encoding', '') != 'chunked': return status, headers, await reader.readexactly(int(headers.get('content-length', 0)))
+
+            chunks = []
+            while True:
+                line = await reader.readline()
+                if not line: raise ConnectionError('Stream ended before the last chunk, the job failed while rendering')
+                size = int(line.strip(), 16)
+                if size == 0: break
+                chunks.append(await reader.readexactly(size))
+                await reader.readexactly(2)
+            return status, headers, b''.join(chunks)
+        finally:
+            writer.close()
+
+    async def _json(self, method: str, target: str, obj = None):
+        status, _, body = await self.request(method, target, obj)
+        result = json.loads(body)
+        if status != 200: raise HTTPError(status, result.get('error', ''))
+        return result
+
+    async def render(self, job: dict[str, typing.Any]) -> tuple[np.ndarray, int] | dict[str, typing.Any]:
+        """Renders `job`, returns `(audio, sr)` with `(channels, samples)` audio, or the response if the job has `output`."""
+        status, headers, body = await self.request('POST', '/render', job)
+        if headers.get('content-type', '') == 'application/json':
+            result = json.loads(body)
+            if status != 200: raise HTTPError(status, result.get('error', ''))
+            return result
+        audio = np.frombuffer(body, dtype = np.float32).reshape(-1, int(headers['x-channels'])).T
+        return audio, int(headers['x-sample-rate'])
+
+    async def metrics(self) -> dict[str, typing.Any]:
+        return await self._json('GET', '/metrics')
+
+
+async def serve(host: str = '127.0.0.1', port: int = 8765, path: str | None = None, **kwargs):
+    """Runs `RenderServer(**kwargs)` until it is cancelled."""
+    async with await RenderServer(**kwargs).start(host, port, path) as server:
+        print(f'Listening on {server.address}')
+        await server.serve_forever()
+
+
+def main(argv: abc.Sequence[str] | None = None):
+    parser = argparse.ArgumentParser(prog = 'beat_manipulator.server', description = 'Runs a local render server.')
+    parser.add_argument('--host', default = '127.0.0.1', help = 'host to listen on')
+    parser.add_argument('-p', '--port', type = int, default = 8765, help = 'port to listen on')
+    parser.add_argument('--unix', default = None, help = 'path of a Unix socket to listen on instead of host and port')
+    parser.add_argument('-j', '--workers', type = int, default = None, help = 'number of worker threads, defaults to number of CPUs')
+    parser.add_argument('--max-queue', type = int, default = 256, help = 'number of jobs that can wait in the queue')
+    parser.add_argument('--max-sources', type = int, default = 64, help = 'number of decoded sources kept in memory')
+    args = parser.parse_args(argv)
+
+    try:
+        asyncio.run(serve(args.host, args.port, args.unix, workers = args.workers, max_queue = args.max_queue, max_sources = args.max_sources))
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,228 @@
+"""Beats are stored as references to slices of source audio and only turned into an array when rendering."""
+import itertools
+import typing
+from collections import abc
+
+import numpy as np
+
+if typing.TYPE_CHECKING:
+    from .audio import Audio
+
+
+_SEQ = itertools.count()
+"""Order in which overlays were added, they are rendered in this order."""
+
+
+class Segment:
+    """A beat - `source.audio[:, start:stop]`, or `data` if effects were applied to it.
+
+    `length` is the length of the beat in the output, it can differ from length of the audio when a beat is added to it
+    using `shortest`, `longest`, `new`, `median` or `median no pad` length modes.
+
+    `overlays` are beats that were added or multiplied onto this beat, as tuples of
+    `(seq, offset, operation, segment, start, stop, n_op, spans)` - samples `start:stop` of `segment` are put onto this beat at `offset`,
+    first `n_op` samples with `operation` and the rest are copied. `seq` is the order in which overlays were added.
+    If `spans` is not None, the overlay continues onto the next `len(spans) - 1` beats, `spans` are lengths of those beats when it was added."""
+    __slots__ = ('source', 'start', 'stop', 'effects', 'mode', 'data', 'length', 'overlays')
+    def __init__(self, source: "Audio", start: int, stop: int, effects: abc.Sequence = (), mode: str = 'append', data: np.ndarray | None = None):
+        self.source = source
+        self.start = start
+        self.stop = stop
+        self.effects = effects
+        self.mode = mode
+        self.data = data
+        self.length = self.audio_length
+        self.overlays: list[tuple[int, int, typing.Any, Segment, int, int, int, tuple[int, ...] | None]] = []
+
+    @property
+    def audio_length(self):
+        if self.data is not None: return self.data.shape[1]
+        return self.stop - self.start
+
+    @property
+    def audio(self):
+        """Array this segment reads from, without slicing it."""
+        return self.data if self.data is not None else self.source.audio
+
+    def read(self) -> np.ndarray:
+        """Returns audio of this segment without overlays. This is a view of source audio if there are no effects, don't modify it."""
+        if self.data is not None: return self.data
+        return self.source.audio[:, self.start:self.stop]
+
+    def overlay(self, offset: int, operation, segment: "Segment", start: int, stop: int, length_mode: str, median: int | None = None):
+        """Puts `segment[:, start:stop]` onto this segment at `offset` using `operation`,
+        `length_mode` is one of `overflow`, `existing`, `shortest`, `longest`, `new`, `median` and `median no pad`,
+        the median modes use `median` as the new length.
+        Returns how many samples were put, in `overflow` mode the rest should go onto next segments (see `overlay_overflow`)."""
+        n = stop - start
+        remaining = self.length - offset
+
+        # new length of this segment
+        if length_mode in ('overflow', 'existing'): n = min(n, remaining)
+        elif length_mode == 'shortest':
+            n = min(n, remaining)
+            self.length = offset + n
+        elif length_mode == 'longest': self.length = offset + max(n, remaining)
+        elif length_mode == 'new': self.length = offset + n
+        elif length_mode in ('median', 'median no pad'):
+            if median is None: raise ValueError(f'{length_mode = } requires `median`')
+            n = min(n, median - offset)
+            # with padding the rest of the beat is silent
+            if length_mode == 'median': self.length = median
+            else: self.length = min(median, max(self.length, offset + n))
+        else: raise ValueError(f'Invalid {length_mode = }')
+
+        # operation is applied where there is existing audio, past the end new audio is just copied
+        n_op = max(min(n, remaining), 0)
+        if n > 0: self.overlays.append((next(_SEQ), offset, operation, segment, start, start + n, n_op, None))
+        return max(n, 0)
+
+
+def overlay_overflow(segments: abc.Sequence[Segment], index: int, offset: int, operation, segment: Segment, start: int, stop: int):
+    """Puts `segment[:, start:stop]` onto `segments[index]` at `offset` using `operation`, what doesn't fit goes onto next segments.
+    It is stored as a single overlay on `segments[index]` which is rendered with one operation no matter how many segments it spans.
+    Returns `(start, stop)` of the part that didn't fit into any segments, or None."""
+    n = stop - start
+    spans = [segments[index].length]
+    available = spans[0] - offset
+    while available < n and index + len(spans) < len(segments):
+        spans.append(segments[index + len(spans)].length)
+        available += spans[-1]
+
+    n = min(n, max(available, 0))
+    if n > 0: segments[index].overlays.append((next(_SEQ), offset, operation, segment, start, start + n, n, tuple(spans)))
+
+    start += n
+    if start >= stop: return None
+    return start, stop
+
+
+def split_spans(segments: abc.Sequence[Segment], index: int):
+    """Splits overlays that span across position `index` into one overlay per segment, use this before inserting a segment at `index`
+    so that spanned overlays stay on the segments they were put onto instead of continuing onto the inserted segment."""
+    for i, seg in enumerate(segments[:index]):
+        overlays = []
+        for seq, offset, operation, segment, start, stop, n_op, spans in seg.overlays:
+            if spans is None or i + len(spans) <= index:
+                overlays.append((seq, offset, operation, segment, start, stop, n_op, spans))
+                continue
+
+            # each segment gets the part that fits into the length it had when the overlay was added
+            for k, length in enumerate(spans):
+                n = min(length - offset, stop - start)
+                if n > 0:
+                    piece = (seq, offset, operation, segment, start, start + n, max(min(n_op, n), 0), None)
+                    if k == 0: overlays.append(piece)
+                    else: segments[i + k].overlays.append(piece)
+                start += n
+                n_op -= n
+                offset = 0
+                if start >= stop: break
+        seg.overlays = overlays
+
+
+def split_overlays(segments: abc.Sequence[Segment], n: int):
+    """Cuts overlays of first `n` segments that span past them, the rest of each of them is moved to `segments[n]`.
+    Use this before rendering first `n` segments separately from the rest."""
+    if n >= len(segments): return
+    for i, seg in enumerate(segments[:n]):
+        for j, (seq, offset, operation, segment, start, stop, n_op, spans) in enumerate(seg.overlays):
+            if spans is None or i + len(spans) <= n: continue
+
+            # overlays are put onto each segment according to lengths it was added with, so it is cut at the same place
+            split = min(start + sum(spans[:n - i]) - offset, stop)
+            seg.overlays[j] = (seq, offset, operation, segment, start, split, min(n_op, split - start), spans[:n - i])
+            if split < stop:
+                segments[n].overlays.append((seq, 0, operation, segment, split, stop, max(n_op - (split - start), 0), spans[n - i:]))
+
+
+def _render_base(segment: Segment, out: np.ndarray):
+    audio = segment.read()
+    n = min(audio.shape[1], segment.length)
+    out[:, :n] = audio[:, :n]
+
+
+def _render_overlay(out: np.ndarray, overlay: tuple, offsets: abc.Sequence[int], i: int):
+    """Renders overlay of `i`th segment onto `out`, `offsets[k]` is where `k`th segment starts in `out`, with one more offset for the end."""
+    seq, offset, operation, segment, start, stop, n_op, spans = overlay
+    n_spans = 1 if spans is None else len(spans)
+    end = min(i + n_spans, len(offsets) - 1)
+
+    # spanned segments changed length after the overlay was added, each of them gets its part of the overlay,
+    # length of the last one doesn't matter because the overlay is cut to it anyway
+    if spans is not None and any(offsets[k + 1] - offsets[k] != spans[k - i] for k in range(i, min(i + n_spans - 1, end))):
+        for k in range(i, end):
+            n = spans[k - i] - offset
+            _render_overlay(out, (seq, offset, operation, segment, start, min(start + n, stop), n, None), offsets, k)
+            start += n
+            offset = 0
+            if start >= stop: return
+        return
+
+    begin = offsets[i] + offset
+    limit = offsets[end]
+    if begin >= limit: return
+    stop = min(stop, start + limit - begin)
+    audio = segment.read()[:, start:stop]
+    n_op = min(n_op, audio.shape[1])
+
+    target = out[:, begin:begin+n_op]
+    operation(target, audio[:, :n_op], out = target)
+    out[:, begin+n_op:begin+audio.shape[1]] = audio[:, n_op:]
+
+
+def fade_boundaries(out: np.ndarray, offsets: abc.Sequence[int], fade: int, start = False, end = False):
+    """Fades `out` out before and in after every boundary between segments with raised cosine windows of `fade` samples,
+    all boundaries are processed with one vectorized operation. `offsets` are starts of segments in `out` with one more offset for the end.
+    Each fade is at most half of its segment long. If `start` or `end` are True, start and end of `out` are faded too,
+    which is used when `out` is a part of a longer output."""
+    if fade <= 0 or len(offsets) < 2: return
+    offsets = np.asarray(offsets, dtype = np.int64)
+    lengths = np.diff(offsets)
+
+    # fade out before boundaries `1:`, and fade in after boundaries `:-1`
+    out_stop = offsets[1:] if end else offsets[1:-1]
+    out_len = np.minimum(lengths[:len(out_stop)] // 2, fade)
+    in_start = offsets[:-1] if start else offsets[1:-1]
+    in_len = np.minimum(lengths[len(lengths) - len(in_start):] // 2, fade)
+
+    k = np.arange(fade)
+    # fade out of `n` samples ends at the boundary, fade in starts at it, `j` is position within the fade
+    out_pos = out_stop[:, None] - fade + k
+    out_j = k - (fade - out_len[:, None])
+    in_pos = in_start[:, None] + k
+    in_j = np.broadcast_to(k, in_pos.shape)
+
+    out_mask = out_j >= 0
+    in_mask = in_j < in_len[:, None]
+    out_gain = 0.5 * (1 + np.cos(np.pi * (out_j + 0.5) / np.maximum(out_len[:, None], 1)))
+    in_gain = 0.5 * (1 - np.cos(np.pi * (in_j + 0.5) / np.maximum(in_len[:, None], 1)))
+
+    # faded samples don't overlap because each fade is at most half of its segment
+    index = np.concatenate([out_pos[out_mask], in_pos[in_mask]])
+    gain = np.concatenate([out_gain[out_mask], in_gain[in_mask]]).astype(out.dtype)
+    out[:, index] *= gain
+
+
+def render(segments: abc.Sequence[Segment], dtype = None, channels: int | None = None, fade: int = 0, fade_edges: tuple[bool, bool] = (False, False)) -> np.ndarray:
+    """Renders all segments into a single preallocated array.
+    Audio of all segments is written first, then overlays are applied in the order they were added.
+    If `fade` is more than 0, boundaries between segments are faded out and in over `fade` samples to remove clicks,
+    `fade_edges` are whether to fade start and end of the output as well (see `fade_boundaries`)."""
+    if len(segments) == 0: return np.zeros((channels or 0, 0), dtype = dtype or np.float32)
+
+    offsets = [0, *itertools.accumulate(s.length for s in segments)]
+    if dtype is None: dtype = np.result_type(*{s.audio.dtype for s in segments})
+    if channels is None: channels = max(s.audio.shape[0] for s in segments)
+
+    out = np.zeros((channels, offsets[-1]), dtype = dtype)
+    overlays = []
+    for i, segment in enumerate(segments):
+        _render_base(segment, out[:, offsets[i]:offsets[i+1]])
+        overlays.extend((overlay, i) for overlay in segment.overlays)
+
+    overlays.sort(key = lambda x: x[0][0])
+    for overlay, i in overlays: _render_overlay(out, overlay, offsets, i)
+
+    fade_boundaries(out, offsets, fade, *fade_edges)
+    return out
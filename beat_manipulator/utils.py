@@ -1,16 +1,8 @@
+import hashlib
 import math
+import sys
 from collections import abc
-import numpy as np, torch
-
-def get_next_key(d: dict, key):
-    """Returns key from `d` that is after `key`"""
-    keys = list(d.keys())
-    index = keys.index(key)
-    if index == len(keys) - 1:
-        return keys[0]
-    else:
-        return keys[index + 1]
-
+import numpy as np
 
 def interpolate(seq: abc.Sequence[float] | np.ndarray, i: float):
     """Same as `seq[i]` but `i` can be float and it will interpolate the value"""
@@ -25,42 +17,21 @@ def interpolate(seq: abc.Sequence[float] | np.ndarray, i: float):
 
 
 def tonumpy(x):
-    if isinstance(x, torch.Tensor): return x.detach().cpu().numpy()
-    elif isinstance(x, np.ndarray): return x
-    else: return np.asarray(x)
+    if isinstance(x, np.ndarray): return x
+    # if torch isn't imported, `x` can't be a tensor, so torch is never imported here
+    torch = sys.modules.get('torch', None)
+    if torch is not None and isinstance(x, torch.Tensor): return x.detach().cpu().numpy()
+    return np.asarray(x)
 
 def totensor(x):
+    import torch
     if isinstance(x, torch.Tensor): return x
     else: return torch.from_numpy(tonumpy(x))
 
 
-def op_with_overflow(op, beat:np.ndarray, audio: np.ndarray):
-    """Applies `op` which adds `audio` to `beat`. If `beat` is longer than audio, remainder is the overflow."""
-
-    # audio is longer
-    if audio.shape[1] > beat.shape[1]:
-        beat = op(beat, audio[:, :beat.shape[1]])
-        return beat, audio[:, beat.shape[1]:]
-
-    # beat is longer
-    beat[:, :audio.shape[1]] = op(beat[:, :audio.shape[1]], audio)
-    return beat, None
-
-
-def op_on_longest(op, x1: np.ndarray, x2: np.ndarray):
-    """Applies a SYMMETRIC operation on x1 and x2 which can be different lengths, returns longest."""
-    if x1.shape[1] >= x2.shape[1]:
-        x1[:, :x2.shape[1]] = op(x1[:, :x2.shape[1]], x2)
-        return x1
-    else:
-        x2[:, :x1.shape[1]] = op(x2[:, :x1.shape[1]], x1)
-        return x2
-    
-def op_on_shortest(op, x1: np.ndarray, x2: np.ndarray):
-    """Applies a SYMMETRIC operation on x1 and x2 which can be different lengths, returns shortest."""
-    if x1.shape[1] >= x2.shape[1]:
-        x1[:, :x2.shape[1]] = op(x1[:, :x2.shape[1]], x2)
-        return x1[:, :x2.shape[1]]
-    else:
-        x2[:, :x1.shape[1]] = op(x2[:, :x1.shape[1]], x1)
-        return x2[:, :x1.shape[1]]
\ No newline at end of file
+def audio_hash(audio: np.ndarray, sr: int, chunk: int = 2**20) -> str:
+    """Hash of `(channels, samples)` audio and sr, hashed in chunks of samples so that it doesn't need a contiguous copy."""
+    h = hashlib.sha1(f'{audio.shape} {audio.dtype} {sr}'.encode())
+    for i in range(0, audio.shape[1], chunk):
+        h.update(np.ascontiguousarray(audio[:, i:i+chunk]).tobytes())
+    return h.hexdigest()
@@ -0,0 +1,40 @@
+"""Measures time of `import beat_manipulator` in a fresh interpreter and checks that heavy backends aren't imported with it,
+they should only be imported on first use (beat detection, pedalboard effects and audio files, `totensor`).
+
+Run with `python benchmarks/bench_import.py`, exits with code 1 if any of `HEAVY` modules were imported."""
+import json
+import subprocess
+import sys
+
+HEAVY = ('torch', 'beat_this', 'pedalboard')
+
+_CODE = '''
+import json, sys, time
+start = time.perf_counter()
+import beat_manipulator
+elapsed = time.perf_counter() - start
+print(json.dumps({"time": elapsed, "imported": [m for m in %r if m in sys.modules]}))
+''' % (HEAVY, )
+
+
+def measure(repeats: int = 5) -> dict:
+    times = []
+    imported = set()
+    for _ in range(repeats):
+        output = subprocess.run([sys.executable, '-c', _CODE], capture_output = True, text = True, check = True).stdout
+        result = json.loads(output.strip().splitlines()[-1])
+        times.append(result['time'])
+        imported.update(result['imported'])
+    return {'time': min(times), 'imported': sorted(imported)}
+
+
+def main():
+    result = measure()
+    print(f"import beat_manipulator: {result['time'] * 1000:.1f} ms")
+    if len(result['imported']) > 0:
+        print(f"heavy modules imported: {', '.join(result['imported'])}")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,74 @@
+"""Compares `downbeat_consistency_fixedBPM` with the original implementation on synthetic downbeats.
+
+Run from the repository root with `python -m benchmarks.bench_postprocessing`."""
+import itertools
+import time
+
+import numpy as np
+
+from beat_manipulator.postprocessing import downbeat_consistency_fixedBPM
+
+
+def reference_downbeat_consistency_fixedBPM(audio, downbeats):
+    """Original implementation, builds a distance matrix for every downbeat."""
+    lengths = np.diff(downbeats)
+    median_length = np.median(lengths)
+
+    middlepoint_errors = []
+    for d1, d2 in itertools.pairwise(downbeats):
+        projected_forward = np.arange(int(d1), audio.shape[1], median_length)
+        projected_backward = np.arange(int(d1), 0, -median_length)
+        projected = np.concatenate([projected_backward[::-1][:-1], projected_forward])
+        diff_mat = np.abs(projected[:,None] - downbeats)
+        closest = downbeats[np.argmin(diff_mat, axis = 1).astype(int)]
+        middlepoint_errors.append(np.abs(projected - closest).sum())
+
+    best_point = downbeats[np.argmin(middlepoint_errors)]
+
+    projected_forward = np.arange(int(best_point), audio.shape[1], median_length)
+    projected_backward = np.arange(int(best_point), 0, -median_length)
+    proj_downbeats = np.concatenate([projected_backward[::-1][:-1], projected_forward])
+
+    proj_beats = []
+    for d1, d2 in itertools.pairwise(proj_downbeats):
+        downbeat_length = d2 - d1
+        beat_length = downbeat_length / 4
+        proj_beats.extend([d1, d1 + beat_length, d1 + beat_length * 2, d1 + beat_length * 3])
+
+    return proj_beats, proj_downbeats
+
+
+def synthetic_downbeats(minutes: float, bpm: float = 128, sr: int = 44100, jitter: float = 0.01, seed = 0):
+    """Returns `(audio, downbeats)` where audio is a placeholder with the right shape and downbeats are a 4/4 grid with random jitter."""
+    rng = np.random.default_rng(seed)
+    length = int(minutes * 60 * sr)
+    bar = 4 * 60 / bpm * sr
+    downbeats = np.arange(bar / 3, length, bar)
+    downbeats = np.sort(downbeats + rng.normal(0, jitter * bar, len(downbeats)))
+    audio = np.broadcast_to(np.float32(0), (2, length))
+    return audio, downbeats
+
+
+def bench(fn, *args, repeats = 3):
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = fn(*args)
+        times.append(time.perf_counter() - start)
+    return min(times), result
+
+
+def main():
+    print(f"{'minutes':>8} {'downbeats':>10} {'reference':>10} {'new':>10} {'speedup':>8}")
+    for minutes in (1, 3, 10, 30):
+        audio, downbeats = synthetic_downbeats(minutes)
+        ref_time, (ref_beats, ref_downbeats) = bench(reference_downbeat_consistency_fixedBPM, audio, downbeats)
+        new_time, (new_beats, new_downbeats) = bench(downbeat_consistency_fixedBPM, audio, downbeats)
+
+        assert np.allclose(ref_downbeats, new_downbeats), 'downbeats differ'
+        assert np.allclose(ref_beats, new_beats), 'beats differ'
+        print(f'{minutes:>8} {len(downbeats):>10} {ref_time:>9.4f}s {new_time:>9.4f}s {ref_time / new_time:>7.1f}x')
+
+
+if __name__ == '__main__':
+    main()
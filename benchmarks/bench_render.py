@@ -0,0 +1,152 @@
+"""Benchmarks of the render pipeline on synthetic audio with a fixed beat grid, so beat detection is skipped and no GPU or network is needed.
+
+Measures throughput (seconds of output rendered per second) and peak memory of representative patterns,
+and time of individual hot paths like slicing and effects.
+
+Run from the repository root with `python -m benchmarks.bench_render --output results.json`, and `--compare old.json` to print changes relative to a previous run."""
+import argparse
+import json
+import platform
+import time
+import tracemalloc
+from collections import abc
+
+import numpy as np
+
+from beat_manipulator.audio import Audio
+from beat_manipulator.beatswap_ import Beatswap, parse_pattern
+from beat_manipulator.effects.effect import EFFECT_CACHE, EFFECTS, PLUGINS, apply_effects
+
+
+def synthetic_audio(seconds: float, sr: int = 44100, bpm: float = 128, channels: int = 2, seed = 0) -> Audio:
+    """Noise with a fixed beat grid injected into `Audio.beats`."""
+    rng = np.random.default_rng(seed)
+    audio = Audio(rng.uniform(-0.5, 0.5, (channels, int(seconds * sr))).astype(np.float32), sr)
+    audio.beats = np.arange(0, audio.audio.shape[1], 60 / bpm * sr)
+    audio.downbeats = audio.beats[::4]
+    return audio
+
+
+def _effects(*names: str, cache = False) -> list[dict]:
+    args = {'vol': [0.5], 'spd': [1.5], 'dwn': [4], 'grd': [2], 'bcr': [8], 'pit': [3], 'str': [1.5], 'cmp': [4], 'rvb': []}
+    return [{'function': name, 'args': args.get(name, []), 'cache': cache} for name in names]
+
+def _numpy_effects():
+    return ['vol', 'spd', 'dwn', 'grd', 'bcr', 'rev', 'nrm', 'clp']
+
+def _pedalboard_available():
+    try: import pedalboard # pylint:disable=W0611,C0415
+    except ImportError: return False
+    return True
+
+
+def patterns() -> dict[str, dict]:
+    """Representative patterns."""
+    p = {}
+
+    p['reorder'] = parse_pattern('0, 2, 1, 3', 4)
+
+    p['overlays'] = {
+        0: {'start': 0, 'increment': 1},
+        1: {'start': 0.5, 'length': 1.5, 'mode': 'add', 'index': -1, 'increment': 1},
+        2: {'start': 0, 'length': 0.25, 'mode': 'multiply', 'index': -1, 'increment': 1, 'length mode': 'existing'},
+        3: {'start': 0.25, 'length': 0.5, 'mode': 'add', 'index': -1, 'increment': 1, 'length mode': 'longest'},
+        4: {'start': 0.75, 'length': 0.25, 'mode': 'add', 'index': -1, 'increment': 1, 'length mode': 'shortest'},
+    }
+
+    names = _numpy_effects()
+    if _pedalboard_available(): names += ['pit', 'rvb']
+    p['effects'] = {0: {'start': 0, 'increment': 1, 'effects': _effects(*names)}}
+
+    # same slice with same effects over and over, effect cache is used
+    p['repeated effects'] = {
+        0: {'start': 0, 'increment': 1},
+        1: {'start': 4, 'length': 1, 'effects': _effects(*names, cache = True)},
+    }
+
+    p['shuffle'] = {i: {'start': i, 'increment': 64, 'shuffle group': i % 4} for i in range(64)}
+    p['shuffle always'] = {i: {'start': i, 'increment': 64, 'shuffle always group': 0} for i in range(64)}
+    return p
+
+
+def measure(fn: abc.Callable, repeats: int) -> dict[str, float]:
+    """Returns best time and peak memory allocated by `fn` over `repeats` runs."""
+    times = []
+    peak = 0
+    for _ in range(repeats):
+        EFFECT_CACHE.clear()
+        tracemalloc.start()
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+        peak = max(peak, tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+    return {'time': min(times), 'peak_bytes': peak}
+
+
+def bench_patterns(audio: Audio, repeats: int) -> dict[str, dict]:
+    results = {}
+    for name, pattern in patterns().items():
+        output = Beatswap(pattern, {'__main_audio__': audio}).run()
+        result = measure(lambda pattern = pattern: Beatswap(pattern, {'__main_audio__': audio}).run(), repeats) # pylint:disable=W0640
+        result['output_seconds'] = output.shape[1] / audio.sr
+        result['throughput'] = result['output_seconds'] / result['time']
+        results[name] = result
+        print(f"{name:>20}: {result['throughput']:>10.1f}x realtime, peak {result['peak_bytes'] / 2**20:>8.1f} MiB")
+    return results
+
+
+def bench_hot_paths(audio: Audio, repeats: int) -> dict[str, dict]:
+    results = {}
+    n = len(audio) - 2
+    positions = np.linspace(0, n, 4096)
+
+    results['getitem'] = measure(lambda: [audio[p:p + 1] for p in positions], repeats)
+    results['slice_many'] = measure(lambda: audio.slice_many(positions, positions + 1), repeats)
+
+    beat = audio[4:5]
+    for name in EFFECTS:
+        if name in PLUGINS or name == 'str':
+            if not _pedalboard_available(): continue
+        effects = [(e['function'], e['args'], {}) for e in _effects(name)]
+        results[f'effect {name}'] = measure(lambda effects = effects: apply_effects(beat, audio.sr, effects, cache = None), repeats) # pylint:disable=W0640
+
+    for name, result in results.items():
+        print(f"{name:>20}: {result['time'] * 1000:>10.3f} ms, peak {result['peak_bytes'] / 2**20:>8.1f} MiB")
+    return results
+
+
+def compare(results: dict, old: dict):
+    """Prints relative change of time and peak memory of every benchmark that is in both results."""
+    print('\nchange relative to previous run:')
+    for group in ('patterns', 'hot_paths'):
+        for name, result in results[group].items():
+            if name not in old.get(group, {}): continue
+            prev = old[group][name]
+            print(f"{name:>20}: time {result['time'] / prev['time'] - 1:>+8.1%}, peak {result['peak_bytes'] / max(prev['peak_bytes'], 1) - 1:>+8.1%}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description = __doc__)
+    parser.add_argument('--seconds', type = float, default = 180, help = 'length of synthetic audio')
+    parser.add_argument('--repeats', type = int, default = 3)
+    parser.add_argument('--output', default = None, help = 'path to save results to as JSON')
+    parser.add_argument('--compare', default = None, help = 'path to results of a previous run')
+    args = parser.parse_args()
+
+    audio = synthetic_audio(args.seconds)
+    results = {
+        'info': {'seconds': args.seconds, 'repeats': args.repeats, 'python': platform.python_version(), 'numpy': np.__version__, 'time': time.time()},
+        'patterns': bench_patterns(audio, args.repeats),
+        'hot_paths': bench_hot_paths(audio, args.repeats),
+    }
+
+    if args.output is not None:
+        with open(args.output, 'w', encoding = 'utf8') as f: json.dump(results, f, indent = 2)
+
+    if args.compare is not None:
+        with open(args.compare, 'r', encoding = 'utf8') as f: compare(results, json.load(f))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,21 @@
+import sys
+
+import numpy as np
+
+from beat_manipulator.audio import Audio
+from beat_manipulator.beat_detection import BeatDetector
+from beat_manipulator.cache import DiskCache
+
+
+def test_cached_beats_dont_import_torch(tmp_path, monkeypatch):
+    cache = DiskCache(str(tmp_path))
+    detector = BeatDetector()
+    audio = Audio(np.zeros((2, 1000), dtype = np.float32), 1000)
+    beats, downbeats = np.arange(0, 1000, 100), np.arange(0, 1000, 400)
+    cache.set(detector._key(audio.hash, audio.sr), beats = beats, downbeats = downbeats)
+
+    # importing torch raises an error
+    monkeypatch.setitem(sys.modules, 'torch', None)
+    detector.detect_many([audio], cache = cache)
+    np.testing.assert_array_equal(audio.beats, beats)
+    np.testing.assert_array_equal(audio.downbeats, downbeats)
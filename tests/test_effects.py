@@ -0,0 +1,37 @@
+import itertools
+
+import numpy as np
+import pytest
+
+from beat_manipulator.effects.effect import apply_effect, apply_effects, get_board
+
+pytest.importorskip('pedalboard')
+
+SR = 44100
+ARGS = {'pit': (3, ), 'cmp': (), 'rvb': ()}
+
+
+def _audio():
+    return np.random.default_rng(0).uniform(-0.5, 0.5, (2, SR // 2)).astype(np.float32)
+
+
+@pytest.mark.parametrize('chain', [c for n in (2, 3) for c in itertools.product(ARGS, repeat = n)])
+def test_fused_plugins_match_sequential(chain):
+    effects = [(effect, ARGS[effect], {}) for effect in chain]
+    audio = _audio()
+    expected = audio
+    for effect, args, kwargs in effects: expected = apply_effect(expected, SR, effect, args, kwargs)
+    np.testing.assert_allclose(apply_effects(audio, SR, effects, cache = None), expected, atol = 1e-6)
+
+
+def test_board_plugins_are_not_shared():
+    board = get_board([('pit', (3, ), {}), ('rvb', (), {}), ('pit', (3, ), {})])
+    assert board[0] is not board[2]
+
+
+def test_mixed_chain_doesnt_modify_input():
+    audio = _audio()
+    copy = audio.copy()
+    out = apply_effects(audio, SR, [('vol', (0.5, ), {}), ('rvb', (), {}), ('rev', (), {}), ('clp', (), {})], cache = None)
+    np.testing.assert_array_equal(audio, copy)
+    assert out.dtype == audio.dtype and out.shape == audio.shape
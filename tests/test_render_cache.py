@@ -0,0 +1,57 @@
+import numpy as np
+import pytest
+
+from beat_manipulator import render_cache
+from beat_manipulator.audio import Audio
+from beat_manipulator.beatswap_ import beatswap_dict
+from beat_manipulator.cache import DiskCache
+
+SR = 8000
+PATTERN = {0: {'start': 0, 'increment': 1}, 1: {'start': 0, 'mode': 'add', 'index': -1, 'increment': 2}}
+
+
+def _song():
+    rng = np.random.default_rng(0)
+    audio = Audio(rng.uniform(-0.5, 0.5, (2, SR * 4)).astype(np.float32), SR)
+    audio.beats = np.arange(0, SR * 4, SR // 4)
+    return audio
+
+
+def _lookups():
+    return dict(render_cache.STATS)
+
+
+def test_array_render_is_cached(tmp_path):
+    cache = DiskCache(str(tmp_path))
+    before = _lookups()
+    first = beatswap_dict(_song(), PATTERN, seed = 1, cache = cache)
+    second = beatswap_dict(_song(), PATTERN, seed = 1, cache = cache)
+
+    assert render_cache.STATS['misses'] - before['misses'] == 1
+    assert render_cache.STATS['hits'] - before['hits'] == 1
+    np.testing.assert_array_equal(first, second)
+
+
+def test_file_render_is_cached(tmp_path):
+    pedalboard = pytest.importorskip('pedalboard')
+    cache = DiskCache(str(tmp_path / 'cache'))
+    before = _lookups()
+    first = beatswap_dict(_song(), PATTERN, seed = 1, cache = cache, output = str(tmp_path / 'first.wav'))
+    second = beatswap_dict(_song(), PATTERN, seed = 1, cache = cache, output = str(tmp_path / 'second.wav'))
+
+    assert render_cache.STATS['misses'] - before['misses'] == 1
+    assert render_cache.STATS['hits'] - before['hits'] == 1
+    with open(first, 'rb') as f1, open(second, 'rb') as f2: assert f1.read() == f2.read()
+    with pedalboard.io.AudioFile(second) as f: assert f.frames > 0
+
+
+def test_key_changes():
+    song = _song()
+    key = render_cache.render_key({'__main_audio__': song}, PATTERN, 1)
+    assert render_cache.render_key({'__main_audio__': song}, PATTERN, None) is None
+    assert render_cache.render_key({'__main_audio__': song}, PATTERN, 2) != key
+    # order of operations
+    assert render_cache.render_key({'__main_audio__': song}, dict(reversed(PATTERN.items())), 1) != key
+    # beat grid
+    song.beats = song.beats + 1
+    assert render_cache.render_key({'__main_audio__': song}, PATTERN, 1) != key
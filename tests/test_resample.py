@@ -0,0 +1,57 @@
+import threading
+import concurrent.futures
+
+import numpy as np
+
+from beat_manipulator import audio as audio_module
+from beat_manipulator.audio import Audio
+from beat_manipulator.resample import resample
+
+
+def test_sine_is_preserved():
+    sr, target = 48000, 44100
+    t = np.arange(sr) / sr
+    x = np.stack([np.sin(2 * np.pi * 1000 * t), np.sin(2 * np.pi * 5000 * t)]).astype(np.float32)
+    y = resample(x, sr, target)
+
+    assert y.shape == (2, target)
+    t = np.arange(target) / target
+    expected = np.stack([np.sin(2 * np.pi * 1000 * t), np.sin(2 * np.pi * 5000 * t)])
+    np.testing.assert_allclose(y[:, 200:-200], expected[:, 200:-200], atol = 1e-4)
+
+
+def test_frequencies_above_new_nyquist_are_removed():
+    t = np.arange(96000) / 96000
+    y = resample(np.sin(2 * np.pi * 30000 * t)[None].astype(np.float32), 96000, 44100)
+    assert np.sqrt(np.mean(y[:, 200:-200] ** 2)) < 1e-3
+
+
+def test_beats_are_rescaled():
+    audio = Audio(np.zeros((1, 48000), dtype = np.float32), 48000)
+    audio.beats = np.array([0, 12000, 24000, 36000])
+    resampled = audio.resampled(24000, cache = None)
+    assert resampled.audio.shape == (1, 24000)
+    np.testing.assert_allclose(resampled.beats, [0, 6000, 12000, 18000])
+    assert audio.resampled(24000, cache = None) is resampled
+
+
+def test_resampling_of_other_sources_doesnt_wait(monkeypatch):
+    release = threading.Event()
+    calls = []
+    def slow_resample(audio, sr, target_sr):
+        calls.append(audio.shape[1])
+        if audio.shape[1] == 1000: assert release.wait(10)
+        return np.zeros((audio.shape[0], audio.shape[1] * target_sr // sr), dtype = np.float32)
+    monkeypatch.setattr(audio_module, 'resample', slow_resample)
+
+    slow = Audio(np.zeros((1, 1000), dtype = np.float32), 1000)
+    fast = Audio(np.zeros((1, 2000), dtype = np.float32), 1000)
+    with concurrent.futures.ThreadPoolExecutor(3) as executor:
+        slow_futures = [executor.submit(slow.resampled, 2000, None) for _ in range(2)]
+        # finishes while the other source is being resampled
+        assert executor.submit(fast.resampled, 2000, None).result(timeout = 10).audio.shape == (1, 4000)
+        release.set()
+        results = [f.result(timeout = 10) for f in slow_futures]
+
+    assert results[0] is results[1]
+    assert calls.count(1000) == 1
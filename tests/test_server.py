@@ -0,0 +1,146 @@
+import asyncio
+import json
+
+import numpy as np
+import pytest
+
+from beat_manipulator.audio import Audio
+from beat_manipulator.beatswap_ import Beatswap
+from beat_manipulator.server import HTTPError, RenderClient, RenderServer
+
+SR = 8000
+PATTERN = {
+    0: {'start': 0, 'increment': 1},
+    1: {'start': 0.5, 'mode': 'add', 'index': -1, 'increment': 1},
+}
+
+
+def _song():
+    rng = np.random.default_rng(0)
+    audio = Audio(rng.uniform(-0.5, 0.5, (2, SR * 4)).astype(np.float32), SR)
+    audio.beats = np.arange(0, SR * 4, SR // 4)
+    return audio
+
+
+def _serve(test, workers = 2):
+    """Runs `test(server, client)` against a server on a free port that has a synthetic song `song`."""
+    async def main():
+        async with await RenderServer(workers = workers).start(port = 0) as server:
+            server.sources.put('song', _song())
+            host, port = server.address[:2]
+            return await test(server, RenderClient(host, port))
+    return asyncio.run(main())
+
+
+def test_streamed_render():
+    async def test(server, client):
+        return await client.render({'song': 'song', 'pattern': PATTERN})
+
+    audio, sr = _serve(test)
+    expected = Beatswap(PATTERN, {'__main_audio__': _song()}).run()
+    assert sr == SR
+    np.testing.assert_allclose(audio, expected)
+
+
+def test_string_pattern_and_max_seconds():
+    async def test(server, client):
+        return await client.render({'song': 'song', 'pattern': '1, 3, 2, 4', 'increment': 4, 'max_seconds': 1.5})
+
+    audio, _ = _serve(test)
+    assert audio.shape == (2, int(SR * 1.5))
+
+
+def test_output(tmp_path):
+    pedalboard = pytest.importorskip('pedalboard')
+    output = str(tmp_path / 'out' / 'render.wav')
+
+    async def test(server, client):
+        return await client.render({'song': 'song', 'pattern': PATTERN, 'output': output})
+
+    assert _serve(test) == {'output': output}
+    with pedalboard.io.AudioFile(output) as f:
+        assert f.samplerate == SR
+        audio = f.read(f.frames)
+    expected = Beatswap(PATTERN, {'__main_audio__': _song()}).run()
+    np.testing.assert_allclose(audio, expected, atol = 1e-4)
+
+
+def test_failing_job():
+    async def test(server, client):
+        with pytest.raises(HTTPError) as e:
+            await client.render({'song': 'song', 'pattern': {0: {'start': 0, 'mode': 'invalid'}}})
+        assert e.value.status == 500
+
+        # fails after the first blocks were streamed
+        pattern = {0: {'start': 0, 'increment': 1}, 1: {'start': 0, 'effects': [{'function': 'nonexistent'}]}}
+        with pytest.raises(ConnectionError):
+            await client.render({'song': 'song', 'pattern': pattern})
+
+        with pytest.raises(HTTPError) as e:
+            await client.render({'song': 'song'})
+        assert e.value.status == 400
+
+        # server still works after failed jobs
+        audio, _ = await client.render({'song': 'song', 'pattern': PATTERN})
+        return audio, await client.metrics()
+
+    audio, metrics = _serve(test)
+    assert audio.shape[1] > 0
+    assert metrics['failed'] == 2
+    assert metrics['completed'] == 1
+
+
+def test_metrics():
+    async def test(server, client):
+        await asyncio.gather(*(client.render({'song': 'song', 'pattern': PATTERN}) for _ in range(4)))
+        return await client.metrics()
+
+    metrics = _serve(test)
+    assert metrics['queue depth'] == 0
+    assert metrics['running'] == 0
+    assert metrics['completed'] == 4
+    assert metrics['failed'] == 0
+    assert metrics['sources']['hits'] == 4
+    assert metrics['sources']['misses'] == 0
+    assert metrics['latency seconds']['max'] >= metrics['latency seconds']['p50'] > 0
+    assert metrics['wait seconds']['mean'] is not None
+
+
+def test_one_shots_are_not_detected():
+    pattern = {0: {'start': 0, 'increment': 1}, 1: {'source': 'one shot', 'source mode': 'seconds', 'start': 0, 'stop': 0.1, 'mode': 'add', 'index': -1}}
+    one_shot = Audio(np.ones((2, SR), dtype = np.float32), SR)
+
+    async def test(server, client):
+        server.sources.put('one shot', one_shot)
+        return await client.render({'song': 'song', 'pattern': pattern})
+
+    audio, _ = _serve(test)
+    assert one_shot.beats is None
+    np.testing.assert_allclose(audio, Beatswap(pattern, {'__main_audio__': _song(), 'one shot': one_shot}).run())
+
+
+def test_slow_client_and_disconnect():
+    """The render waits for a client that doesn't read, and stops when the client disconnects."""
+    long_song = Audio(np.zeros((2, SR * 400), dtype = np.float32), SR)
+    long_song.beats = np.arange(0, SR * 400, SR)
+
+    async def test(server, client):
+        server.sources.put('long', long_song)
+        reader, writer = await asyncio.open_connection(client.host, client.port)
+        body = json.dumps({'song': 'long', 'pattern': {0: {'start': 0, 'increment': 1}}}).encode()
+        writer.write(f'POST /render HTTP/1.1\r\nContent-Length: {len(body)}\r\n\r\n'.encode() + body)
+        await reader.readuntil(b'\r\n\r\n')
+
+        await asyncio.sleep(0.5)
+        waiting = server.metrics()
+        writer.close()
+        for _ in range(100):
+            if server.metrics()['cancelled'] == 1: break
+            await asyncio.sleep(0.05)
+        return waiting, server.metrics()
+
+    waiting, metrics = _serve(test, workers = 1)
+    assert waiting['running'] == 1
+    assert waiting['completed'] == 0
+    assert metrics['cancelled'] == 1
+    assert metrics['completed'] == 0
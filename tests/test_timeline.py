@@ -0,0 +1,84 @@
+import numpy as np
+import pytest
+
+from beat_manipulator.audio import Audio
+from beat_manipulator.beatswap_ import Beatswap
+
+BEAT = 2000
+
+
+def _song(n_beats = 40):
+    rng = np.random.default_rng(0)
+    audio = Audio(rng.uniform(-0.5, 0.5, (2, BEAT * n_beats)).astype(np.float32), 44100)
+    audio.beats = np.arange(0, BEAT * n_beats, BEAT)
+    return audio
+
+
+def _beat(song: Audio, start: float, stop: float):
+    return song.audio[:, int(start * BEAT):int(stop * BEAT)].copy()
+
+
+def _add(beats: list[np.ndarray], index: int, audio: np.ndarray):
+    """Adds `audio` onto `beats[index]` and what doesn't fit onto the next beats, like `overflow` length mode."""
+    pos = 0
+    for beat in beats[index:] if index >= 0 else beats[len(beats) + index:]:
+        n = min(beat.shape[1], audio.shape[1] - pos)
+        beat[:, :n] += audio[:, pos:pos + n]
+        pos += n
+
+
+def test_insert_into_spanned_overlay():
+    """An overlay that overflows over three beats, then a beat is inserted between them, all beats have equal lengths."""
+    song = _song()
+    pattern = {
+        0: {'start': 0, 'increment': 1},
+        2: {'start': 1, 'increment': 1},
+        3: {'start': 2, 'increment': 1},
+        4: {'start': 20, 'length': 2.5, 'mode': 'add', 'index': -3},
+        5: {'start': 25, 'mode': 'insert', 'index': -1},
+    }
+
+    # reference with every beat as a separate array, ends when a beat goes past the second to last beat of the song
+    beats = []
+    i = 0
+    while i + 3 < 39:
+        beats.extend(_beat(song, s + i, s + i + 1) for s in (0, 1, 2))
+        _add(beats, -3, _beat(song, 20, 22.5))
+        beats.insert(len(beats) - 1, _beat(song, 25, 26))
+        i += 1
+    beats.extend(_beat(song, s + i, s + i + 1) for s in (0, 1) if s + i + 1 < 39)
+    expected = np.concatenate(beats, axis = 1)
+
+    np.testing.assert_allclose(Beatswap(pattern, {'__main_audio__': song}).run(), expected)
+
+
+def test_overflow_onto_appended_beats():
+    song = _song()
+    pattern = {
+        0: {'start': 0, 'increment': 1},
+        1: {'start': 10, 'length': 2.5, 'mode': 'add', 'index': -1},
+    }
+
+    # reference output with all added audio at its position, overflow past the last beat is dropped
+    expected = np.concatenate([_beat(song, i, i + 1) for i in range(38)], axis = 1)
+    for i in range(38):
+        audio = _beat(song, 10, 12.5)[:, :expected.shape[1] - i * BEAT]
+        expected[:, i * BEAT:i * BEAT + audio.shape[1]] += audio
+
+    np.testing.assert_allclose(Beatswap(pattern, {'__main_audio__': song}).run(), expected, atol = 1e-6)
+
+
+@pytest.mark.parametrize('fade', [0, 16])
+def test_blocks_match_full_render(fade):
+    song = _song()
+    pattern = {
+        0: {'start': 0, 'increment': 1},
+        2: {'start': 1, 'increment': 1},
+        4: {'start': 20, 'length': 2.5, 'mode': 'add', 'index': -2},
+        5: {'start': 25, 'mode': 'insert', 'index': -1},
+        6: {'start': 30, 'stop': 30.5, 'mode': 'multiply', 'index': -1.5, 'length mode': 'new'},
+    }
+    full = Beatswap(pattern, {'__main_audio__': song}, fade = fade).run()
+    blocks = list(Beatswap(pattern, {'__main_audio__': song}, fade = fade).iter_blocks())
+    assert len(blocks) > 1
+    np.testing.assert_allclose(np.concatenate(blocks, axis = 1), full)